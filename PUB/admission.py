@@ -0,0 +1,219 @@
+import ipaddress
+import json
+import logging
+import queue
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+from common.clock import RealClock
+from common.compression import MAX_INTERNED
+from common.rate_limit import TokenBucket
+from common.util import Util
+from data.schema import registry
+
+# every request a subscriber sends is a json object starting with this
+REQUEST_MAGIC = b'{"request"'
+
+_REQUESTS = ('register', 'unregister')
+
+
+class RequestAdmission(object):
+    """
+    Front end of the publisher control port. The receiving thread only
+    runs the cheap checks (size, magic, per host rate), then the request
+    waits in a bounded queue for a worker that parses and validates it, so
+    a registration storm is dropped early instead of starving the streams.
+    """
+
+    def __init__(self, handler: Callable[[Dict], None],
+                 max_request_size: int = Util.max_request_size,
+                 rate: float = Util.request_rate,
+                 burst: float = Util.request_burst,
+                 queue_size: int = Util.request_queue_size,
+                 max_sources: int = Util.max_request_sources,
+                 clock=None) -> None:
+        """
+        :param handler: called with every valid request, on the worker
+        :param max_request_size: bigger datagrams are dropped unparsed
+        :param rate: requests per second allowed from each host, all its
+                     subscribers together whatever their source port
+        :param burst: requests a host may send at once
+        :param queue_size: requests waiting to be handled, beyond that
+                           new requests are dropped
+        :param max_sources: hosts whose rate is tracked, the least
+                            recently heard are forgotten
+        :param clock: a VirtualClock waits for the queue to drain
+        """
+        self._handler = handler
+        self._max_request_size = max_request_size
+        self._rate = rate
+        self._burst = burst
+        self._max_sources = max_sources
+        self._buckets: 'OrderedDict[str, TokenBucket]' = OrderedDict()
+        self._queue: 'queue.Queue[Optional[Tuple[bytes, tuple]]]' = \
+            queue.Queue(queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(('accepted', 'malformed', 'invalid',
+                                     'rate_limited', 'queue_full'), 0)
+        self._clock = clock if clock else RealClock()
+        self._clock.AddIdleCheck(self.IsIdle)
+
+    def Start(self) -> None:
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._Serve, daemon=True)
+        self._thread.start()
+
+    def Stop(self, timeout: float = Util.drain_timeout) -> None:
+        """
+        stops the worker, the requests still queued are dropped
+        """
+        if not self._thread:
+            return
+        while True:
+            try:
+                self._queue.put_nowait(None)
+                break
+            except queue.Full:
+                self._Drain()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def Admit(self, datagram: bytes, src_addr: tuple) -> bool:
+        """
+        runs the cheap checks on a datagram read from the control port
+        and queues it, called by the receiving thread
+
+        :param datagram: the datagram as read
+        :param src_addr: (ip, port) it came from
+        :return: True if the request was queued
+        """
+        if len(datagram) > self._max_request_size or \
+                not datagram.startswith(REQUEST_MAGIC):
+            self._Count('malformed')
+            return False
+        if not self._Bucket(src_addr).TryAcquire():
+            self._Count('rate_limited')
+            return False
+        try:
+            self._queue.put_nowait((datagram, src_addr))
+        except queue.Full:
+            self._Count('queue_full')
+            return False
+        return True
+
+    def Stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats)
+
+    def IsIdle(self) -> bool:
+        # unfinished tasks count the queued requests and the one handled
+        with self._queue.all_tasks_done:
+            return not self._queue.unfinished_tasks
+
+    def _Serve(self) -> None:
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                datagram, src_addr = item
+                request = self._Parse(datagram, src_addr)
+                if request is not None:
+                    self._Count('accepted')
+                    self._handler(request)
+            except Exception as e:
+                logging.error(f"Exception {e} caught while handling "
+                              f"request from {item[1]}")
+            finally:
+                self._queue.task_done()
+
+    def _Parse(self, datagram: bytes, src_addr: tuple) -> Optional[Dict]:
+        """
+        :return: the request, None if it is not valid
+        """
+        try:
+            request = json.loads(datagram.decode('utf-8'))
+        except ValueError:
+            self._Count('malformed')
+            return None
+        try:
+            ValidateRequest(request, src_addr)
+        except ValueError as e:
+            self._Count('invalid')
+            logging.debug(f"dropped request from {src_addr}: {e}")
+            return None
+        return request
+
+    def _Bucket(self, src_addr: tuple) -> TokenBucket:
+        # keyed by ip, a new source port does not get a new burst
+        host = src_addr[0]
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = TokenBucket(self._rate, self._burst, self._clock)
+                self._buckets[host] = bucket
+                if len(self._buckets) > self._max_sources:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(host)
+            return bucket
+
+    def _Drain(self) -> None:
+        try:
+            self._queue.get_nowait()
+            self._queue.task_done()
+        except queue.Empty:
+            pass
+
+    def _Count(self, stat: str) -> None:
+        with self._lock:
+            self._stats[stat] += 1
+
+
+def ValidateRequest(request: Dict, src_addr: tuple) -> None:
+    """
+    checks a parsed request before the publisher acts on it
+
+    :param request: the parsed request
+    :param src_addr: (ip, port) the request came from
+    :return: None
+    :exception: ValueError if the request is not valid
+    """
+    if not isinstance(request, dict):
+        raise ValueError("request is not an object")
+    if request.get('request') not in _REQUESTS:
+        raise ValueError(f"unknown request {request.get('request')!r}")
+    shape = request.get('shape')
+    if not _IsInt(shape) or registry.LatestVersion(shape) is None:
+        raise ValueError(f"unknown shape {shape!r}")
+    port = request.get('udp_port')
+    if not _IsInt(port) or not 0 < port < 65536:
+        raise ValueError(f"invalid port {port!r}")
+    ip = request.get('udp_ip')
+    try:
+        claimed = ipaddress.IPv4Address(ip)
+    except ValueError:
+        raise ValueError(f"invalid ip {ip!r}")
+    # the updates and the ACK go to the claimed address, which must be
+    # the sender, or a loopback address when the sender is this host
+    if ip != src_addr[0] and \
+            not (claimed.is_loopback and Util.IsLocalIp(src_addr[0])):
+        raise ValueError(f"{src_addr[0]} claims to be {ip}")
+    for key in ('schema', 'replay_seq'):
+        if key in request and not _IsInt(request[key]):
+            raise ValueError(f"invalid {key} {request[key]!r}")
+    if 'replay_ts' in request and \
+            not isinstance(request['replay_ts'], (int, float)):
+        raise ValueError(f"invalid replay_ts {request['replay_ts']!r}")
+    if 'compression' in request:
+        known = request['compression']
+        if not isinstance(known, dict) or \
+                not all(_IsInt(count) and 0 <= count <= MAX_INTERNED
+                        for count in known.values()):
+            raise ValueError(f"invalid compression {known!r}")
+
+
+def _IsInt(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
@@ -0,0 +1,233 @@
+import bisect
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+from common.util import Util
+
+# length of the payload, sequence, timestamp. a zero length marks the end
+# of the written part of a segment
+_RECORD = struct.Struct('!IQd')
+_SEGMENT_NAME = re.compile(r'^(\d+)_(\d{20})\.seg$')
+
+
+class _Segment(object):
+    """
+    A preallocated, memory mapped file holding consecutive records of a
+    single stream, along with its in memory offset index.
+    """
+
+    def __init__(self, path: str, size: int, create: bool) -> None:
+        self.path = path
+        self._file = open(path, 'w+b' if create else 'r+b')
+        if create:
+            self._file.truncate(size)
+        self.size = os.fstat(self._file.fileno()).st_size
+        self.map = mmap.mmap(self._file.fileno(), self.size)
+        # offset index, parallel lists so they can be bisected
+        self.seqs: List[int] = []
+        self.stamps: List[float] = []
+        self.offsets: List[int] = []
+        self.write_offset = 0
+        if not create:
+            self._Scan()
+
+    def Fits(self, payload_len: int) -> bool:
+        # keep room for the zero length end marker
+        return self.write_offset + _RECORD.size * 2 + payload_len <= self.size
+
+    def Append(self, seq: int, stamp: float, payload: bytes) -> None:
+        offset = self.write_offset
+        end = offset + _RECORD.size + len(payload)
+        self.map[offset:offset + _RECORD.size] = \
+            _RECORD.pack(len(payload), seq, stamp)
+        self.map[offset + _RECORD.size:end] = payload
+        self.write_offset = end
+        self.seqs.append(seq)
+        self.stamps.append(stamp)
+        self.offsets.append(offset)
+
+    def Payload(self, index: int) -> memoryview:
+        offset = self.offsets[index]
+        length, _, _ = _RECORD.unpack_from(self.map, offset)
+        start = offset + _RECORD.size
+        return memoryview(self.map)[start:start + length]
+
+    def Retire(self) -> None:
+        """
+        removes the segment file. the mapping itself is released once
+        readers still streaming from it are done with it
+        """
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            logging.error(f"failed to remove journal segment {self.path}: {e}")
+        try:
+            self.map.close()
+        except BufferError:
+            pass  # still exported to a replay, closed when collected
+        self._file.close()
+
+    def _Scan(self) -> None:
+        offset = 0
+        while offset + _RECORD.size <= self.size:
+            length, seq, stamp = _RECORD.unpack_from(self.map, offset)
+            if not length or offset + _RECORD.size + length > self.size:
+                break
+            self.seqs.append(seq)
+            self.stamps.append(stamp)
+            self.offsets.append(offset)
+            offset += _RECORD.size + length
+        self.write_offset = offset
+
+
+class StreamJournal(object):
+    """
+    Append only journal of the encoded messages of each shape type.
+    Each stream is kept in memory mapped segment files, oldest segments are
+    dropped according to the time and size retention.
+    """
+
+    def __init__(self, directory: str,
+                 segment_size: int = Util.journal_segment_size,
+                 retention_seconds: Optional[float] =
+                 Util.journal_retention_seconds,
+                 retention_bytes: Optional[int] =
+                 Util.journal_retention_bytes) -> None:
+        """
+        :param directory: where the segment files are kept
+        :param segment_size: size in bytes of each segment file
+        :param retention_seconds: drop segments older than that, None keeps
+        :param retention_bytes: bound on the bytes kept per stream,
+                                None keeps
+        """
+        self._directory = directory
+        self._segment_size = segment_size
+        self._retention_seconds = retention_seconds
+        self._retention_bytes = retention_bytes
+        self._segments: Dict[int, List[_Segment]] = {}
+        self._next_seq: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._Load()
+
+    def Append(self, shape_type: int, payload: bytes) -> int:
+        """
+        appends an encoded message to the journal of its stream
+
+        :param shape_type: the stream
+        :param payload: the encoded message
+        :return: sequence number of the message
+        """
+        if _RECORD.size * 2 + len(payload) > self._segment_size:
+            raise ValueError(f"message of {len(payload)} bytes does not fit "
+                             f"in a journal segment")
+        stamp = time.time()
+        with self._lock:
+            segments = self._segments.setdefault(shape_type, [])
+            seq = self._next_seq.get(shape_type, 0)
+            if not segments or not segments[-1].Fits(len(payload)):
+                segments.append(self._NewSegment(shape_type, seq))
+                self._ApplyRetention(segments, stamp)
+            segments[-1].Append(seq, stamp, payload)
+            self._next_seq[shape_type] = seq + 1
+        return seq
+
+    def NextSeq(self, shape_type: int) -> int:
+        return self._next_seq.get(shape_type, 0)
+
+    def Read(self, shape_type: int, from_seq: Optional[int] = None,
+             from_ts: Optional[float] = None) \
+            -> Iterator[Tuple[int, memoryview]]:
+        """
+        streams the journaled messages of a stream straight from the
+        mapped segments, without copying them
+
+        :param shape_type: the stream
+        :param from_seq: first sequence to return
+        :param from_ts: first timestamp to return, used if from_seq is None
+        :return: iterator of (sequence, message)
+        """
+        with self._lock:
+            segments = list(self._segments.get(shape_type, []))
+        if from_seq is not None:
+            keys = [segment.seqs[0] if segment.seqs else 0
+                    for segment in segments]
+            start = max(bisect.bisect_right(keys, from_seq) - 1, 0)
+        elif from_ts is not None:
+            keys = [segment.stamps[-1] if segment.stamps else 0.0
+                    for segment in segments]
+            start = bisect.bisect_left(keys, from_ts)
+        else:
+            start = 0
+
+        for segment in segments[start:]:
+            if from_seq is not None:
+                index = bisect.bisect_left(segment.seqs, from_seq)
+            elif from_ts is not None:
+                index = bisect.bisect_left(segment.stamps, from_ts)
+            else:
+                index = 0
+            # the last segment may grow while it is being read
+            while index < len(segment.offsets):
+                try:
+                    yield segment.seqs[index], segment.Payload(index)
+                except ValueError:
+                    return  # segment was retired under our feet
+                index += 1
+
+    def Close(self) -> None:
+        with self._lock:
+            for segments in self._segments.values():
+                for segment in segments:
+                    segment.map.flush()
+                    try:
+                        segment.map.close()
+                    except BufferError:
+                        pass
+            self._segments = {}
+
+    def _NewSegment(self, shape_type: int, first_seq: int) -> _Segment:
+        path = os.path.join(self._directory,
+                            f"{int(shape_type)}_{first_seq:020d}.seg")
+        return _Segment(path, self._segment_size, create=True)
+
+    def _ApplyRetention(self, segments: List[_Segment], now: float) -> None:
+        # never drop the segment being written
+        while len(segments) > 1:
+            oldest = segments[0]
+            expired = self._retention_seconds is not None and \
+                oldest.stamps and \
+                now - oldest.stamps[-1] > self._retention_seconds
+            too_big = self._retention_bytes is not None and \
+                len(segments) * self._segment_size > self._retention_bytes
+            if not expired and not too_big:
+                break
+            segments.pop(0).Retire()
+
+    def _Load(self) -> None:
+        """
+        reopens the segments left by a previous run and rebuilds the index
+        """
+        found: Dict[int, List[Tuple[int, str]]] = {}
+        for name in os.listdir(self._directory):
+            match = _SEGMENT_NAME.match(name)
+            if match:
+                found.setdefault(int(match.group(1)), []).append(
+                    (int(match.group(2)), name))
+        for shape_type, names in found.items():
+            segments = []
+            for _, name in sorted(names):
+                segment = _Segment(os.path.join(self._directory, name),
+                                   self._segment_size, create=False)
+                if segment.seqs:
+                    segments.append(segment)
+                else:
+                    segment.Retire()
+            if segments:
+                self._segments[shape_type] = segments
+                self._next_seq[shape_type] = segments[-1].seqs[-1] + 1
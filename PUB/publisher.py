@@ -2,40 +2,116 @@ import atexit
 import inspect
 import socket
 import threading
-import time
-from typing import List, Dict
+from typing import Callable, List, Dict, Optional, Set
 from PUB.IPub import IPublisher
-from common.util import Util, PublisherParams
+from PUB.admission import RequestAdmission
+from PUB.journal import StreamJournal
+from PUB.scheduler import SendScheduler
+from common.batch import Batcher
+from common.clock import RealClock
+from common.compression import Compressor
+from common.fragment import Fragmenter
+from common.rate_limit import TokenBucket
+from common.transport import UdpTransport
+from common.util import Util, PublisherParams, Priority
 from custom_Logger.custom_logger import MyLogger
 from data.factory_shape import ShapeType
+from data.schema import registry, MessageVersion
 import logging
 
 
+class _Stream(object):
+    """
+    A running publishing stream and the means to stop it
+    """
+    __slots__ = ('params', 'stop_event', 'thread')
+
+    def __init__(self, params: PublisherParams,
+                 stop_event: threading.Event,
+                 thread: threading.Thread) -> None:
+        self.params = params
+        self.stop_event = stop_event
+        self.thread = thread
+
+
 class Publisher(IPublisher):
     def __init__(self, publisher_port_num: int,
-                 pub_params: List[PublisherParams]) -> None:
+                 pub_params: List[PublisherParams],
+                 recv_buf_size: int = Util.max_buf_size,
+                 mtu: int = Util.mtu,
+                 sock_buf_size: Optional[int] = None,
+                 batch_linger: float = Util.batch_linger,
+                 journal_dir: Optional[str] = None,
+                 transport=None,
+                 clock=None,
+                 interest_handler: Optional[
+                     Callable[[ShapeType, bool], None]] = None,
+                 request_rate: float = Util.request_rate,
+                 request_burst: float = Util.request_burst) -> None:
         """
         Initializes the Publisher.
         :param publisher_port_num: Port number for the publisher.
         :param pub_params: list of configuration dict for publishing method
+        :param recv_buf_size: bytes read per request datagram
+        :param mtu: biggest datagram sent, bigger shapes are fragmented
+        :param sock_buf_size: kernel send/receive buffers of the sockets,
+                              system default when None
+        :param batch_linger: seconds an update waits for other updates
+                             bound to the same subscriber
+        :param journal_dir: when given, every published message is journaled
+                            there and can be replayed to subscribers
+        :param transport: where the sockets come from, UdpTransport when None
+                          (see common/transport.py for the loopback one)
+        :param clock: time source of the streams, RealClock when None
+        :param interest_handler: called as interest_handler(shape, True) when
+                                 a shape gets its first subscriber and
+                                 interest_handler(shape, False) when it
+                                 loses its last one
+        :param request_rate: registrations per second admitted from each
+                             host, see PUB/admission.py
+        :param request_burst: registrations a host may send at once
         """
         super().__init__()
         # concrete initialization
-        self._sock_fd = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
-                                      socket.IPPROTO_UDP)
+        self._transport = transport if transport else UdpTransport()
+        self._clock = clock if clock else RealClock()
+        self._sock_fd = self._transport.Socket()
         self._publisher_port_num = publisher_port_num
         self._publisher_address = ('', publisher_port_num)
         self._recv_thread = threading.Thread(target=self._RecvRequests)
         #  in order to allow gracefully shutdown
         self._recv_thread.daemon = True
-        self._pub_params = pub_params  # concrete property
-        self._udp_unicast_sock = socket.socket(socket.AF_INET,
-                                               socket.SOCK_DGRAM,
-                                               socket.IPPROTO_UDP)
+        self._pub_params = list(pub_params)  # concrete property
+        self._streams: Dict[int, _Stream] = {}
+        self._streams_lock = threading.RLock()
+        self._stop_event = self._clock.Event()
+        self._announce_thread = None
+        self._atexit_registered = False
+        self._recv_buf_size = recv_buf_size
+        self._fragmenter = Fragmenter(mtu)
+        # compresses what goes to the subscribers that asked for it
+        self._compressor = Compressor()
+        # requests are checked and queued by the receiving thread, and
+        # handled by the admission worker
+        self._admission = RequestAdmission(self._HandleData,
+                                           rate=request_rate,
+                                           burst=request_burst,
+                                           clock=self._clock)
+        self._batcher = Batcher(self._SendDatagram, mtu, batch_linger,
+                                self._clock)
+        self._scheduler = SendScheduler(self._clock)
+        # schema version negotiated per (shape, subscriber), json if missing
+        self._sub_schema: Dict[tuple, int] = {}
+        self._journal = StreamJournal(journal_dir) if journal_dir else None
+        # (shape, subscriber) replayed to, until the subscriber unregisters
+        self._replayed: Set[tuple] = set()
+        self._interest_handler = interest_handler
+        self._udp_unicast_sock = self._transport.Socket()
         # self._udp_ack_sock = socket.socket(socket.AF_INET,
         #                                        socket.SOCK_DGRAM,
         #                                        socket.IPPROTO_UDP)
         # self._udp_sub_conn = {}
+        Util.SetSockBufSize(self._sock_fd, sock_buf_size, sock_buf_size)
         MyLogger.Init("myPubSub_logger", "../Log/pub.log")
 
         self._Execute()
@@ -53,22 +129,140 @@ class Publisher(IPublisher):
         #     self._udp_ack_sock.close()
 
     def Publish(self) -> None:
-        self._is_publishing = True
-        for pub_params in self._pub_params:
-            shape_type = pub_params.shape_type
-            freq = pub_params.freq
-            params = pub_params.params
-            threading.Thread(target=self._PublishByFreq,
-                             args=(shape_type, freq, params)).start()
+        with self._streams_lock:
+            if self._is_publishing or self._stop_event.is_set():
+                return
+            self._is_publishing = True
+            self._batcher.Start()
+            self._scheduler.Start()
+            self._announce_thread = threading.Thread(target=self._Announce,
+                                                     daemon=True)
+            self._announce_thread.start()
+            self._clock.Track(self._announce_thread)
+            for pub_params in self._pub_params:
+                self._StartStream(pub_params)
+        if not self._atexit_registered:
             atexit.register(self.Stop)
-            logging.debug(self.__class__.__name__ + " starting to publish")
+            self._atexit_registered = True
+        logging.debug(self.__class__.__name__ + " starting to publish")
+
+    def Stop(self, timeout: float = Util.drain_timeout) -> None:
+        """
+        Stops the publisher gracefully: the streams stop, the updates still
+        pending are sent, the subscribers are told about the shutdown so they
+        fail over right away, and every worker is joined.
+        :param timeout: seconds to wait for each worker
+        """
+        with self._streams_lock:
+            if self._stop_event.is_set():
+                return
+            self._stop_event.set()
+            self._is_publishing = False
+            streams, self._streams = list(self._streams.values()), {}
+            for stream in streams:
+                stream.stop_event.set()
+        for stream in streams:
+            stream.thread.join(timeout)
+        if self._announce_thread:
+            self._announce_thread.join(timeout)
+        # drain the updates still waiting in the scheduler and the batcher
+        self._scheduler.Stop(timeout)
+        self._batcher.Stop()
+        self._NotifyShutdown()
 
-    def Stop(self):
-        self._is_publishing = False
         self._is_running = False
-        self._recv_thread.join(1)
+        try:
+            # wakes up the receiving thread blocked on recvfrom
+            self._sock_fd.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+        self._recv_thread.join(timeout)
+        self._admission.Stop(timeout)
+        if self._journal:
+            self._journal.Close()
         logging.debug("stopped publishing")
 
+    def AddStream(self, pub_params: PublisherParams) -> None:
+        """
+        Starts publishing a new shape stream, without a restart.
+        :param pub_params: the stream configuration
+        :exception: ValueError if the shape is already published
+        """
+        with self._streams_lock:
+            if any(params.shape_type == pub_params.shape_type
+                   for params in self._pub_params):
+                raise ValueError(f"{pub_params.shape_type} is already "
+                                 f"published")
+            self._pub_params = self._pub_params + [pub_params]
+            if self._is_publishing:
+                self._StartStream(pub_params)
+        logging.info(f"added stream {pub_params}")
+
+    def RemoveStream(self, shape_type: ShapeType) -> None:
+        """
+        Stops publishing a shape stream. its subscribers stay registered
+        and get updates again once the stream is added back.
+        :param shape_type: the stream to remove
+        """
+        with self._streams_lock:
+            self._pub_params = [params for params in self._pub_params
+                                if params.shape_type != shape_type]
+            stream = self._streams.pop(shape_type, None)
+        if stream:
+            stream.stop_event.set()
+            stream.thread.join(Util.drain_timeout)
+        logging.info(f"removed stream {shape_type}")
+
+    def UpdateStream(self, pub_params: PublisherParams) -> None:
+        """
+        Retunes a published stream (frequency, params...) in place.
+        :param pub_params: the new configuration of the stream
+        """
+        with self._streams_lock:
+            self.RemoveStream(pub_params.shape_type)
+            self.AddStream(pub_params)
+
+    def Reconfigure(self, pub_params: List[PublisherParams]) -> None:
+        """
+        Hot reconfiguration: streams missing from the list are removed, new
+        ones are added and changed ones are retuned. Registered subscribers
+        are kept.
+        :param pub_params: the complete new list of streams
+        """
+        wanted = {params.shape_type: params for params in pub_params}
+        with self._streams_lock:
+            current = {params.shape_type: params
+                       for params in self._pub_params}
+            for shape_type in current:
+                if shape_type not in wanted:
+                    self.RemoveStream(shape_type)
+            for shape_type, params in wanted.items():
+                if shape_type not in current:
+                    self.AddStream(params)
+                elif current[shape_type] != params:
+                    self.UpdateStream(params)
+
+    def Forward(self, shape_type: ShapeType, params: List) -> None:
+        """
+        Sends an update that was not produced by one of the streams, e.g.
+        one received from another publisher, to the subscribers of the shape.
+        :param shape_type: the shape of the update
+        :param params: the shape params
+        """
+        if self._journal:
+            self._journal.Append(shape_type, Util.EncodeShape(
+                shape_type, params, registry.LatestVersion(shape_type)))
+        if self._sub_map.get(shape_type):
+            self._scheduler.Submit(shape_type, self._NotifyShape,
+                                   (shape_type, params))
+
+    def CompressionStats(self) -> Dict[str, int]:
+        """
+        :return: bytes of the datagrams sent to compressing subscribers,
+                 before and after compression
+        """
+        return self._compressor.Stats()
+
     # Private method:
     def _Execute(self) -> None:
         """
@@ -79,6 +273,7 @@ class Publisher(IPublisher):
                 self._is_running = True
                 Util.SetServerSockToMulticast(self._sock_fd,
                                               self._publisher_port_num)
+                self._admission.Start()
                 self._recv_thread.start()
 
             except Exception as e:
@@ -96,12 +291,15 @@ class Publisher(IPublisher):
                 # the recv_from returns num of bytes read and
                 # tuple representing sock_addr_in
                 read_n_bytes, src_addr =\
-                    self._sock_fd.recvfrom(Util.max_buf_size)
+                    self._sock_fd.recvfrom(self._recv_buf_size)
                 if not read_n_bytes:
+                    if not self._is_running:
+                        break  # woken up by Stop
                     logging.error("Failed to receive message")
                     raise RuntimeError("Failed to receive message")
-                dict_info = Util.DeserializeJson(read_n_bytes.decode('utf-8'))
-                self._HandleData(dict_info)
+                # parsing, validation and handling happen on the
+                # admission worker, if the request gets through
+                self._admission.Admit(read_n_bytes, src_addr)
 
             except ConnectionResetError as e:
                 # Multicast communication is inherently unreliable, and it is
@@ -122,34 +320,136 @@ class Publisher(IPublisher):
                     f"caught in {function_name}() in"
                     f" {self._RecvRequests.__name__}")
 
-    def _PublishByFreq(self, shape: ShapeType, freq: int, params: List) -> None:
-        shape_type = shape
-        while self._is_publishing:
+    def _StartStream(self, pub_params: PublisherParams) -> None:
+        """
+        starts the worker of a stream, called with the streams lock held
+        """
+        stop_event = self._clock.Event()
+        thread = threading.Thread(target=self._PublishByFreq,
+                                  args=(pub_params, stop_event), daemon=True)
+        self._streams[pub_params.shape_type] = _Stream(pub_params, stop_event,
+                                                       thread)
+        thread.start()
+        self._clock.Track(thread)
+
+    def _PublishByFreq(self, pub_params: PublisherParams,
+                       stop_event: threading.Event) -> None:
+        shape_type = pub_params.shape_type
+        params = pub_params.params
+        while not stop_event.is_set():
             try:
+                if self._journal:
+                    # journaled even with no subscriber, for later replays
+                    self._journal.Append(shape_type, Util.EncodeShape(
+                        shape_type, params,
+                        registry.LatestVersion(shape_type)))
                 if shape_type in self._sub_map:
-                    self._NotifyShape(shape_type, params)
+                    # the scheduler orders the sends of all the streams
+                    # by priority and deadline, the batcher keeps both
+                    # while the update lingers
+                    expires = None
+                    if pub_params.deadline is not None and \
+                            pub_params.priority != Priority.URGENT:
+                        expires = self._clock.Now() + pub_params.deadline
+                    self._scheduler.Submit(shape_type, self._NotifyShape,
+                                           (shape_type, params,
+                                            pub_params.priority, expires),
+                                           pub_params.priority,
+                                           pub_params.weight,
+                                           pub_params.deadline)
             except KeyError as e:
                 logging.error(f"Key Error: {e}")
-            time.sleep(freq)
+            # wakes up right away when the stream is stopped
+            self._clock.Wait(stop_event, pub_params.freq)
+
+    def _Announce(self) -> None:
+        """
+        Periodically announces the publisher, its streams and its load
+        to the subscribers, so they can pick and fail over between publishers
+        """
+        while not self._stop_event.is_set():
+            try:
+                # the admission worker changes the map meanwhile
+                load = sum(len(subs) for subs in list(self._sub_map.values()))
+                Util.SendAnnouncement(self._udp_unicast_sock,
+                                      self._publisher_port_num,
+                                      [p.shape_type for p in self._pub_params],
+                                      load)
+            except socket.error as e:
+                logging.error(f"Failed to announce publisher: {e}")
+            except Exception as e:
+                logging.error(f"Exception {e} caught while announcing")
+            self._clock.Wait(self._stop_event, Util.announce_interval)
 
-    def _NotifyShape(self, shape_type: ShapeType, params: List) -> None:
+    def _NotifyShutdown(self) -> None:
+        """
+        Tells the registered subscribers, and every subscriber listening
+        for discovery, that the publisher is going away
+        """
+        subscribers = {addr for subs in list(self._sub_map.values())
+                       for addr in subs}
+        for addr in subscribers:
+            try:
+                self._sock_fd.sendto(Util.shutdown_msg, addr)
+            except socket.error as e:
+                logging.error(f"Failed to notify {addr} of shutdown: {e}")
+        try:
+            Util.SendShutdownNotice(self._udp_unicast_sock,
+                                    self._publisher_port_num)
+        except socket.error as e:
+            logging.error(f"Failed to announce shutdown: {e}")
+
+    def _NotifyShape(self, shape_type: ShapeType, params: List,
+                     priority: Priority = Priority.NORMAL,
+                     expires: Optional[float] = None) -> None:
         """
         Notifies the subscribers the given shape with the shape information.
         :param shape_type: the shape to be notified
         :param params: list of parameters utilized by the publisher user
+        :param priority: priority class of the stream
+        :param expires: clock time after which the update is stale
         :return: None
         :exception: Can throw RunTime Error - Check log
         """
-        json_data = Util.Serialize(shape_type, params).encode('utf-8')
-        logging.debug(f"{json_data}")
+        if self._compressor.HasSessions():
+            # recurring strings, the colors, are sent as small ids
+            for value in params:
+                if isinstance(value, str):
+                    self._compressor.Intern(value)
+        # encode once per negotiated schema version
+        encoded = {}
+        # the batcher packs updates of all streams bound to the same
+        # subscriber into a single datagram
         for (addr, port) in self._sub_map[shape_type]:
-            try:
-                self._sock_fd.sendto(json_data, (addr, port))
-            except socket.error as e:
-                # if an error occurs, remove subscriber from sub_map
-                logging.error(
-                    f"Error sending data to subscriber at {addr}:{port}: {e}")
-                self._sub_map[shape_type].remove((addr, port))
+            version = self._sub_schema.get((shape_type, (addr, port)))
+            data = encoded.get(version)
+            if data is None:
+                data = Util.EncodeShape(shape_type, params, version)
+                logging.debug(f"{data}")
+                encoded[version] = data
+            self._batcher.Enqueue(data, (addr, port), priority, expires)
+
+    def _SendDatagram(self, payload: bytes, dest: tuple) -> None:
+        """
+        Puts a (possibly batched) payload on the wire, fragmenting it
+        when it does not fit in the mtu.
+        :param payload: encoded message or batch
+        :param dest: (ip, port) of the subscriber
+        :return: None
+        """
+        try:
+            payload = self._compressor.Compress(payload, dest)
+            for datagram in self._fragmenter.Fragment(payload):
+                self._sock_fd.sendto(datagram, dest)
+        except socket.error as e:
+            # if an error occurs, remove subscriber from sub_map
+            logging.error(
+                f"Error sending data to subscriber at {dest[0]}:{dest[1]}: {e}")
+            for shape_type, subscribers in list(self._sub_map.items()):
+                if dest in subscribers:
+                    subscribers.remove(dest)
+                    if not subscribers:
+                        self._NotifyInterest(shape_type, False)
 
     def _RegisterSub(self, shape_type: str, addr: tuple) -> None:
         """
@@ -165,6 +465,8 @@ class Publisher(IPublisher):
             self._sub_map[shape_type].append(addr)
             logging.debug(
                 f"Added subscriber {addr} for shape type {shape_type}")
+            if len(self._sub_map[shape_type]) == 1:
+                self._NotifyInterest(shape_type, True)
         else:
             logging.debug(
                 f"Subscriber {addr} already registered for shape type {shape_type}")
@@ -183,13 +485,29 @@ class Publisher(IPublisher):
         if shape_type in self._sub_map and addr in self._sub_map[shape_type]:
             logging.debug(f"in  delte {shape_type}")
             self._sub_map[shape_type].remove((addr[0], addr[1]))
+            if not self._sub_map[shape_type]:
+                self._NotifyInterest(shape_type, False)
         logging.debug(f"deleted {shape_type}")
 
+    def _NotifyInterest(self, shape_type: int, is_interested: bool) -> None:
+        """
+        tells the interest handler a shape got its first subscriber
+        or lost its last one
+        """
+        if not self._interest_handler:
+            return
+        try:
+            self._interest_handler(shape_type, is_interested)
+        except Exception as e:
+            logging.error(f"Exception {e} caught in interest handler "
+                          f"of {shape_type}")
+
     def _HandleData(self, dict_info: Dict) -> None:
 
         """
         Function to handle the parsed data from the registration request
-        sent by MC_udp
+        sent by MC_udp, once admitted and validated (PUB/admission.py), so
+        the ACK only goes back to the sender
         :param dict_info: dictionary of information relevant for process
         :return:
         """
@@ -209,11 +527,76 @@ class Publisher(IPublisher):
         # self._udp_sub_conn[dict_info['udp_ip']] = dict_info['udp_port']
 
     def _PreformRequest(self, dict_info: Dict) -> None:
+        addr = (dict_info['udp_ip'], dict_info['udp_port'])
         if dict_info['request'] == 'register':
-            self._RegisterSub(dict_info['shape'], (dict_info['udp_ip'],
-                                                   dict_info['udp_port']))
+            self._RegisterSub(dict_info['shape'], addr)
+            version = registry.Negotiate(dict_info['shape'],
+                                         dict_info.get('schema'))
+            if version is None:
+                self._sub_schema.pop((dict_info['shape'], addr), None)
+            else:
+                self._sub_schema[(dict_info['shape'], addr)] = version
+            if 'compression' in dict_info:
+                self._compressor.Open(addr, dict_info['compression'])
+            else:
+                self._compressor.Close(addr)
+            # the subscriber asks for the replay once, from the publisher
+            # it picked. a duplicated request does not replay again
+            key = (dict_info['shape'], addr)
+            if self._journal and key not in self._replayed and \
+                    ('replay_seq' in dict_info or 'replay_ts' in dict_info):
+                self._replayed.add(key)
+                replay_thread = threading.Thread(
+                    target=self._Replay,
+                    args=(dict_info['shape'], addr,
+                          dict_info.get('replay_seq'),
+                          dict_info.get('replay_ts')),
+                    daemon=True)
+                replay_thread.start()
+                # paced on the clock, a virtual one waits for it
+                self._clock.Track(replay_thread)
         elif dict_info['request'] == 'unregister':
-            self._UnRegisterSub(dict_info['shape'], (dict_info['udp_ip'],
-                                                     dict_info['udp_port']))
+            self._UnRegisterSub(dict_info['shape'], addr)
+            self._sub_schema.pop((dict_info['shape'], addr), None)
+            self._replayed.discard((dict_info['shape'], addr))
+            if not any(addr in subs for subs in self._sub_map.values()):
+                self._compressor.Close(addr)
         else:
             logging.error("User tried using invalid request")
+
+    def _Replay(self, shape_type: int, addr: tuple,
+                from_seq: Optional[int], from_ts: Optional[float]) -> None:
+        """
+        Streams the journal of a shape to a newly registered subscriber.
+        Messages go out straight from the journal mapping and are rate
+        limited so live publishing is not starved.
+        :param shape_type: the stream to replay
+        :param addr: the subscriber
+        :param from_seq: first sequence to replay
+        :param from_ts: first timestamp to replay, if from_seq is None
+        :return: None
+        """
+        logging.info(f"replaying {shape_type} to {addr} from seq {from_seq},"
+                     f" ts {from_ts}")
+        version = self._sub_schema.get((shape_type, addr))
+        bucket = TokenBucket(Util.replay_rate, Util.replay_burst,
+                             self._clock)
+        n_sent = 0
+        try:
+            for seq, message in self._journal.Read(shape_type, from_seq,
+                                                   from_ts):
+                if not self._is_running or \
+                        addr not in self._sub_map.get(shape_type, []) or \
+                        not bucket.Acquire(stop_event=self._stop_event):
+                    break
+                if MessageVersion(message) != version:
+                    # journaled with another encoding than the one
+                    # negotiated
+                    message = Util.EncodeShape(
+                        *Util.DecodeShape(bytes(message)), version)
+                self._SendDatagram(message, addr)
+                n_sent += 1
+        except Exception as e:
+            logging.error(f"Exception {e} caught while replaying "
+                          f"{shape_type} to {addr}")
+        logging.info(f"replayed {n_sent} messages of {shape_type} to {addr}")
@@ -0,0 +1,158 @@
+import logging
+import threading
+from typing import Callable, Dict, Hashable, Optional, Tuple
+from common.clock import RealClock
+from common.util import Priority, Util
+
+
+class _Job(object):
+    __slots__ = ('key', 'priority', 'weight', 'deadline', 'func', 'args',
+                 'enqueued')
+
+    def __init__(self, key: Hashable, priority: Priority, weight: int,
+                 deadline: Optional[float], func: Callable, args: Tuple,
+                 enqueued: float) -> None:
+        self.key = key
+        self.priority = priority
+        self.weight = weight
+        self.deadline = deadline
+        self.func = func
+        self.args = args
+        self.enqueued = enqueued
+
+
+class SendScheduler(object):
+    """
+    Serializes the sends of all the streams of a publisher on one thread.
+    Urgent streams are served first, the others share the thread by
+    weight (smooth weighted round robin). Every stream has at most one
+    pending update: a newer one replaces (conflates) it, and a non urgent
+    update older than its deadline is dropped.
+    """
+
+    def __init__(self, clock=None) -> None:
+        """
+        :param clock: time source of the deadlines, RealClock when None
+        """
+        self._clock = clock if clock else RealClock()
+        self._clock.AddIdleCheck(self.IsIdle)
+        self._is_executing = False
+        self._pending: Dict[Hashable, _Job] = {}
+        self._current_weight: Dict[Hashable, int] = {}
+        self._cond = threading.Condition()
+        self._is_running = False
+        self._thread: Optional[threading.Thread] = None
+        self._stats = {'sent': 0, 'conflated': 0, 'dropped': 0}
+
+    def Start(self) -> None:
+        with self._cond:
+            if self._is_running:
+                return
+            self._is_running = True
+        self._thread = threading.Thread(target=self._Run, daemon=True)
+        self._thread.start()
+
+    def Stop(self, timeout: float = Util.drain_timeout) -> None:
+        """
+        stops the scheduler once the pending updates are sent
+        :param timeout: seconds to wait for the sending thread
+        """
+        with self._cond:
+            self._is_running = False
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def Submit(self, key: Hashable, func: Callable, args: Tuple = (),
+               priority: Priority = Priority.NORMAL,
+               weight: Optional[int] = None,
+               deadline: Optional[float] = None) -> None:
+        """
+        queues the send of a stream update
+
+        :param key: the stream, a pending update of the same stream is
+                    replaced
+        :param func: does the send, called as func(*args)
+        :param args: arguments of func
+        :param priority: priority class of the stream
+        :param weight: share of the stream within its class, the class
+                       default when None
+        :param deadline: seconds after which a non urgent update is dropped
+        :return: None
+        """
+        if weight is None:
+            weight = Util.priority_weights[priority]
+        job = _Job(key, priority, max(weight, 1), deadline, func, args,
+                   self._clock.Now())
+        with self._cond:
+            if self._is_running:
+                if key in self._pending:
+                    self._stats['conflated'] += 1
+                self._pending[key] = job
+                self._cond.notify()
+                return
+        # not started, send in the caller thread
+        self._Execute(job)
+
+    def Stats(self) -> Dict[str, int]:
+        with self._cond:
+            return dict(self._stats)
+
+    def IsIdle(self) -> bool:
+        with self._cond:
+            return not self._pending and not self._is_executing
+
+    def _Run(self) -> None:
+        while True:
+            with self._cond:
+                job = self._Next(self._clock.Now())
+                while job is None:
+                    self._is_executing = False
+                    if not self._is_running:
+                        return
+                    self._cond.wait()
+                    job = self._Next(self._clock.Now())
+                self._is_executing = True
+            self._Execute(job)
+
+    def _Next(self, now: float) -> Optional[_Job]:
+        """
+        picks the next update to send, called with the lock held
+        """
+        if not self._pending:
+            return None
+        urgent = [job for job in self._pending.values()
+                  if job.priority == Priority.URGENT]
+        if urgent:
+            job = min(urgent, key=lambda urgent_job: urgent_job.enqueued)
+            return self._pending.pop(job.key)
+
+        for job in list(self._pending.values()):
+            if job.deadline is not None and now - job.enqueued > job.deadline:
+                logging.debug(f"dropping stale update of {job.key}")
+                del self._pending[job.key]
+                self._stats['dropped'] += 1
+        if not self._pending:
+            return None
+
+        total = 0
+        best = None
+        for key, job in self._pending.items():
+            self._current_weight[key] = \
+                self._current_weight.get(key, 0) + job.weight
+            total += job.weight
+            if best is None or \
+                    self._current_weight[key] > self._current_weight[best]:
+                best = key
+        self._current_weight[best] -= total
+        return self._pending.pop(best)
+
+    def _Execute(self, job: _Job) -> None:
+        try:
+            job.func(*job.args)
+            with self._cond:
+                self._stats['sent'] += 1
+        except Exception as e:
+            logging.error(f"Exception {e} caught while sending update "
+                          f"of {job.key}")
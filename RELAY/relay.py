@@ -0,0 +1,123 @@
+import logging
+import threading
+from typing import List, Optional, Set
+from PUB.publisher import Publisher
+from SUB.subscriber import Subscriber
+from common.util import Util, SubscriberParams
+
+
+class _UpstreamSubscriber(Subscriber):
+    """
+    The subscriber of a relay: its updates are forwarded to the local
+    publisher instead of being dispatched, and it keeps running with no
+    shape at all, waiting for local interest.
+    """
+    _stop_when_empty = False
+
+    def __init__(self, sub_params: SubscriberParams, local_pub: Publisher,
+                 transport=None, clock=None) -> None:
+        super().__init__(sub_params, transport, clock)
+        self._local_pub = local_pub
+
+    def _HandleShape(self, shape_type: int, params: List,
+                     src_addr: tuple) -> None:
+        if not self._PruneStray(shape_type, src_addr):
+            return
+        self._local_pub.Forward(shape_type, params)
+
+
+class Relay(object):
+    """
+    Subscribes upstream once per shape on behalf of all its local
+    subscribers and fans the updates out to them, so the upstream publisher
+    sends one copy per site instead of one per subscriber.
+
+    Local subscribers register with the relay as they would with a
+    publisher, on local_port. A shape is subscribed upstream when its first
+    local subscriber registers and unsubscribed when its last one leaves.
+    """
+
+    def __init__(self, upstream_port: int, local_port: int,
+                 upstream_recv_port: int,
+                 batch_linger: float = Util.batch_linger,
+                 discovery: bool = True,
+                 journal_dir: Optional[str] = None,
+                 transport=None,
+                 clock=None) -> None:
+        """
+        :param upstream_port: port the upstream publishers take
+                              registrations on
+        :param local_port: port the local subscribers register on
+        :param upstream_recv_port: port the upstream updates are received on
+        :param batch_linger: seconds a local update waits for other updates
+                             bound to the same subscriber
+        :param discovery: pick and fail over between upstream publishers
+                          from their announcements
+        :param journal_dir: when given, the relayed updates are journaled
+                            and can be replayed to local subscribers
+        :param transport: where the sockets come from, UdpTransport when None
+        :param clock: time source, RealClock when None
+        :exception: ValueError if both sides share the port, the relay
+                    would then register with itself
+        """
+        if upstream_port == local_port:
+            raise ValueError(f"upstream and local port are both "
+                             f"{local_port}")
+        self._upstream_port = upstream_port
+        # shapes subscribed upstream
+        self._interest: Set[int] = set()
+        self._lock = threading.Lock()
+        self._publisher = Publisher(local_port, [],
+                                    batch_linger=batch_linger,
+                                    journal_dir=journal_dir,
+                                    transport=transport, clock=clock,
+                                    interest_handler=self._OnInterest)
+        self._subscriber = _UpstreamSubscriber(
+            SubscriberParams(shape_types=[],
+                             subscriber_udp_recv_port_num=upstream_recv_port,
+                             discovery=discovery),
+            self._publisher, transport, clock)
+        logging.debug(self.__class__.__name__ + " is initialized")
+
+    def Start(self) -> None:
+        self._publisher.Publish()
+        self._subscriber.Subscribe(self._upstream_port)
+        logging.info(f"relaying from port {self._upstream_port}")
+
+    def Stop(self) -> None:
+        """
+        stops the upstream subscription, then the local publisher, so
+        the local subscribers are told about the shutdown and fail over
+        """
+        with self._lock:
+            shapes, self._interest = list(self._interest), set()
+        if shapes:
+            self._subscriber.UnSubscribe(shapes)
+        self._subscriber.Stop()
+        self._publisher.Stop()
+
+    def Interest(self) -> List[int]:
+        """
+        :return: the shapes currently subscribed upstream
+        """
+        with self._lock:
+            return sorted(self._interest)
+
+    def _OnInterest(self, shape_type: int, is_interested: bool) -> None:
+        """
+        aggregates the local registrations into upstream ones, called by
+        the local publisher when a shape gets its first local subscriber or
+        loses its last one
+        """
+        # a plain type id, shapes added to the schema registry have no
+        # ShapeType member
+        with self._lock:
+            is_subscribed = shape_type in self._interest
+            if is_interested and not is_subscribed:
+                logging.info(f"subscribing upstream to {shape_type}")
+                self._interest.add(shape_type)
+                self._subscriber.AddShape([shape_type])
+            elif not is_interested and is_subscribed:
+                logging.info(f"unsubscribing upstream from {shape_type}")
+                self._interest.discard(shape_type)
+                self._subscriber.UnSubscribe([shape_type])
@@ -0,0 +1,60 @@
+import socket
+import struct
+from typing import Iterator, Tuple
+
+# file header, then one record per received datagram
+CAPTURE_MAGIC = b'PSCAP\x01'
+# receive timestamp, source ip, source port, datagram length
+_RECORD = struct.Struct('!d4sHI')
+
+
+class CaptureWriter(object):
+    """
+    Writes the raw datagrams received by a subscriber into a compact
+    binary capture file, to be fed later to the replay driver.
+    Owned by the receiving thread.
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        :param path: capture file, truncated if it exists
+        """
+        self._file = open(path, 'wb')
+        self._file.write(CAPTURE_MAGIC)
+
+    def Write(self, datagram: bytes, src_addr: tuple, stamp: float) -> None:
+        """
+        :param datagram: bytes as read from the socket
+        :param src_addr: (ip, port) of the sender
+        :param stamp: receive time, seconds since epoch
+        :return: None
+        """
+        self._file.write(_RECORD.pack(stamp, socket.inet_aton(src_addr[0]),
+                                      src_addr[1], len(datagram)))
+        self._file.write(datagram)
+
+    def Close(self) -> None:
+        if not self._file.closed:
+            self._file.close()
+
+
+def ReadCapture(path: str) -> Iterator[Tuple[float, tuple, bytes]]:
+    """
+    iterates over a capture file
+
+    :param path: file written by CaptureWriter
+    :return: iterator of (receive time, source address, datagram)
+    :exception: ValueError if the file is not a capture
+    """
+    with open(path, 'rb') as capture:
+        if capture.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        while True:
+            header = capture.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return  # a truncated last record is dropped
+            stamp, ip, port, length = _RECORD.unpack(header)
+            datagram = capture.read(length)
+            if len(datagram) < length:
+                return
+            yield stamp, (socket.inet_ntoa(ip), port), datagram
@@ -0,0 +1,95 @@
+import threading
+from typing import Dict, Iterable, List, Optional
+from common.clock import RealClock
+from common.util import Util
+
+
+class _PublisherInfo(object):
+    __slots__ = ('addr', 'streams', 'load', 'last_seen')
+
+    def __init__(self, addr: tuple) -> None:
+        self.addr = addr
+        self.streams = frozenset()
+        self.load = 0
+        self.last_seen = 0.0
+
+
+class PublisherTable(object):
+    """
+    The publishers a subscriber heard announcing themselves, ranked per
+    shape type by their load. A publisher that was not heard for a
+    heartbeat interval is considered dead.
+    """
+
+    def __init__(self,
+                 heartbeat_interval: float = Util.heartbeat_interval,
+                 clock=None) -> None:
+        """
+        :param heartbeat_interval: seconds of silence after which a
+                                   publisher is dead
+        :param clock: time source, RealClock when None
+        """
+        self._clock = clock if clock else RealClock()
+        self._heartbeat_interval = heartbeat_interval
+        self._publishers: Dict[tuple, _PublisherInfo] = {}
+        self._lock = threading.Lock()
+
+    def Update(self, addr: tuple, streams: Iterable[int], load: int,
+               now: Optional[float] = None) -> bool:
+        """
+        records an announcement
+
+        :param addr: (ip, port) the publisher takes registrations on
+        :param streams: shape types it publishes
+        :param load: its load figure, lower is better
+        :param now: time of the announcement
+        :return: True if the publisher is new (or was dead)
+        """
+        now = self._clock.Now() if now is None else now
+        with self._lock:
+            info = self._publishers.get(addr)
+            is_new = info is None or not self._IsAlive(info, now)
+            if info is None:
+                info = _PublisherInfo(addr)
+                self._publishers[addr] = info
+            info.streams = frozenset(streams)
+            info.load = load
+            info.last_seen = now
+        return is_new
+
+    def Remove(self, addr: tuple) -> None:
+        """
+        forgets a publisher, e.g. one that announced its shutdown
+        """
+        with self._lock:
+            self._publishers.pop(addr, None)
+
+    def IsAlive(self, addr: tuple, now: Optional[float] = None) -> bool:
+        now = self._clock.Now() if now is None else now
+        with self._lock:
+            info = self._publishers.get(addr)
+            return info is not None and self._IsAlive(info, now)
+
+    def Ranked(self, shape_type: int,
+               now: Optional[float] = None) -> List[tuple]:
+        """
+        :param shape_type: the stream looked for
+        :param now: current time
+        :return: addresses of the live publishers of the stream,
+                 least loaded first
+        """
+        now = self._clock.Now() if now is None else now
+        with self._lock:
+            alive = [info for info in self._publishers.values()
+                     if shape_type in info.streams and
+                     self._IsAlive(info, now)]
+        alive.sort(key=lambda info: (info.load, info.addr))
+        return [info.addr for info in alive]
+
+    def Best(self, shape_type: int,
+             now: Optional[float] = None) -> Optional[tuple]:
+        ranked = self.Ranked(shape_type, now)
+        return ranked[0] if ranked else None
+
+    def _IsAlive(self, info: _PublisherInfo, now: float) -> bool:
+        return now - info.last_seen <= self._heartbeat_interval
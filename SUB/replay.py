@@ -0,0 +1,142 @@
+import argparse
+import time
+from typing import Callable, Dict, List
+from SUB.capture import ReadCapture
+from SUB.subscriber import Subscriber
+from common.util import SubscriberParams
+
+STAGES = ('read', 'reassemble', 'decompress', 'unbatch', 'decode',
+          'create', 'dispatch')
+
+# the subscriber method running each stage after the read
+_STAGE_METHODS = {'reassemble': '_Reassemble',
+                  'decompress': '_Decompress',
+                  'unbatch': '_Unbatch',
+                  'decode': '_DecodeMessage',
+                  'create': '_CreateShape',
+                  'dispatch': '_Dispatch'}
+
+
+class ReplayDriver(object):
+    """
+    Feeds a capture file through the receive pipeline of a Subscriber,
+    without a network, and measures the time spent in every stage.
+    """
+
+    def __init__(self, subscriber: Subscriber, capture_path: str,
+                 realtime: bool = False) -> None:
+        """
+        :param subscriber: a subscriber that is not subscribed, its
+                           receive pipeline is run as is
+        :param capture_path: file recorded with SubscriberParams.capture_path
+        :param realtime: keep the recorded pace instead of going as fast
+                         as possible
+        """
+        self._sub = subscriber
+        self._capture_path = capture_path
+        self._realtime = realtime
+        self.timings: Dict[str, float] = dict.fromkeys(STAGES, 0.0)
+        self.counts: Dict[str, int] = dict.fromkeys(STAGES, 0)
+        self.n_errors = 0
+
+    def Run(self) -> float:
+        """
+        replays the whole capture
+
+        :return: wall time of the replay in seconds
+        """
+        self._TimeStages()
+        sub = self._sub
+        clock = time.perf_counter
+        first_stamp = None
+        start = clock()
+        records = iter(ReadCapture(self._capture_path))
+        while True:
+            t0 = clock()
+            record = next(records, None)
+            t1 = clock()
+            if record is None:
+                break
+            self._Add('read', t1 - t0)
+            stamp, src_addr, datagram = record
+
+            if self._realtime:
+                if first_stamp is None:
+                    first_stamp = stamp
+                delay = (stamp - first_stamp) - (clock() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+            sub._HandleDatagram(datagram, src_addr)
+        return clock() - start
+
+    def Report(self) -> List[str]:
+        """
+        :return: lines of a per stage timing table
+        """
+        lines = [f"{'stage':<12}{'count':>10}{'total ms':>12}{'mean us':>10}"]
+        for stage in STAGES:
+            count = self.counts[stage]
+            total = self.timings[stage]
+            mean = total / count * 1e6 if count else 0.0
+            lines.append(f"{stage:<12}{count:>10}{total * 1e3:>12.3f}"
+                         f"{mean:>10.2f}")
+        if self.n_errors:
+            lines.append(f"{self.n_errors} datagrams or messages failed")
+        return lines
+
+    def _TimeStages(self) -> None:
+        """
+        shadows the stage methods of the subscriber with timed ones, so
+        its own _HandleDatagram runs unchanged and is measured
+        """
+        for stage, name in _STAGE_METHODS.items():
+            if name not in vars(self._sub):
+                setattr(self._sub, name,
+                        self._Timed(stage, getattr(self._sub, name)))
+
+    def _Timed(self, stage: str, method: Callable) -> Callable:
+        def Timed(*args):
+            t0 = time.perf_counter()
+            try:
+                result = method(*args)
+            except Exception:
+                self.n_errors += 1
+                raise
+            finally:
+                self._Add(stage, time.perf_counter() - t0)
+            if result is None and stage == 'decompress':
+                self.n_errors += 1
+            return result
+        return Timed
+
+    def _Add(self, stage: str, elapsed: float) -> None:
+        self.timings[stage] += elapsed
+        self.counts[stage] += 1
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="replay a subscriber capture and time the receive path")
+    parser.add_argument('capture', help="capture file to replay")
+    parser.add_argument('--realtime', action='store_true',
+                        help="keep the recorded pace")
+    parser.add_argument('--log', action='store_true',
+                        help="log every shape as a live subscriber does")
+    args = parser.parse_args()
+
+    # port 0, the socket of the subscriber is never used
+    sub_params = SubscriberParams(
+        shape_types=[], subscriber_udp_recv_port_num=0,
+        shape_handler=None if args.log else (lambda shape: None))
+    driver = ReplayDriver(Subscriber(sub_params), args.capture,
+                          args.realtime)
+    elapsed = driver.Run()
+    for line in driver.Report():
+        print(line)
+    print(f"replayed in {elapsed * 1e3:.3f} ms")
+    return 0
+
+
+if __name__ == '__main__':
+    main()
@@ -1,46 +1,92 @@
 import socket
 import logging
 import threading
-import json
 import atexit
 import time
-from typing import Optional, Dict
-import select
+from typing import Optional, Dict, Tuple, List
+from dataclasses import replace
 from SUB.ISub import ISubscribe
+from SUB.discovery import PublisherTable
+from common.batch import Unpack
+from common.clock import RealClock
+from common.compression import COMPRESSED_MAGIC, Decompressor
+from common.fragment import Reassembler
+from common.transport import UdpTransport
 from custom_Logger.custom_logger import MyLogger
-from data.factory_shape import *
+from data.abs_shape import Shape
+from data.factory_shape import ShapeFactory, ShapeType
 from common.util import Util, SubscriberParams
 
 
 class Subscriber(ISubscribe):
-    def __init__(self, sub_params: SubscriberParams):
+    # unsubscribing from the last shape stops the subscriber
+    _stop_when_empty = True
+
+    def __init__(self, sub_params: SubscriberParams, transport=None,
+                 clock=None):
         """
         initializing the subscriber object
         :param sub_params: packed adjustable params
+        :param transport: where the sockets come from, UdpTransport when None
+                          (see common/transport.py for the loopback one)
+        :param clock: time source, RealClock when None
 
         """
         super().__init__()
+        self._transport = transport if transport else UdpTransport()
+        self._clock = clock if clock else RealClock()
         self._sub_params = sub_params
         # properties of the concrete subscriber
         self._shape_types = sub_params.shape_types
         self._factory = ShapeFactory()
-        MyLogger.Init("myPubSub_logger", "../Log/sub.log")
+        # fast start leaves the logger setup to Subscribe, so nothing is
+        # logged, and no log file is created, while constructing
+        if not sub_params.fast_start:
+            MyLogger.Init("myPubSub_logger", "../Log/sub.log")
 
         # uni cast udp socket
-        self._udp_sock = socket.socket(socket.AF_INET,
-                                       socket.SOCK_DGRAM)
-        # BIND the uni cast udp socket
-        self._udp_ip = socket.gethostbyname(socket.gethostname())
+        self._udp_sock = self._transport.Socket()
+        # BIND the uni cast udp socket, fast start avoids the DNS lookup
+        self._udp_ip = self._transport.LocalIp(sub_params.fast_start)
         self._udp_sock.bind((self._udp_ip,
                              self._sub_params.subscriber_udp_recv_port_num))
         # extract the ip from the socket
         self._udp_ip = self._udp_sock.getsockname()[0]
+        Util.SetSockBufSize(self._udp_sock, sub_params.sock_rcvbuf)
+        self._recv_buf_size = sub_params.recv_buf_size or Util.max_buf_size
+        self._reassembler = Reassembler(clock=self._clock)
+        # compressed datagrams are decoded even when compression was not
+        # asked for, e.g. when replaying a capture
+        self._decompressor = Decompressor()
+        self._last_resync = None
+        self._publishers_dict = {}
+        self._shape_handler = sub_params.shape_handler
+        self._capture = None
+        if sub_params.capture_path:
+            # only needed when profiling, kept off the startup path
+            from SUB.capture import CaptureWriter
+            self._capture = CaptureWriter(sub_params.capture_path)
+        self._pub_table = PublisherTable(clock=self._clock)
+        # publisher serving each shape, picked by discovery. shapes without
+        # one are registered through the multicast group
+        self._current_pub: Dict[int, tuple] = {}
+        self._stray_unreg: Dict[tuple, float] = {}
+        # shapes whose journal replay was not asked for yet. it is asked
+        # once, from the publisher picked for the shape, so another
+        # publisher or a later subscription does not replay again
+        self._replay_pending = set(sub_params.shape_types) \
+            if sub_params.replay_from_seq is not None or \
+            sub_params.replay_from_ts is not None else set()
+        self._discovery_sock = None
+        self._discovery_thread = None
         self._sub_is_sending_reg = False
+        self._stop_event = self._clock.Event()
         self._send_reg_lock = threading.Lock()
         self._send_reg_thread = threading.Thread(target=self._SendReg)
         # using at exit in order to close the connections gracefully
         atexit.register(self.UnSubscribe)
-        logging.debug(self.__class__.__name__ + " is initialized")
+        if not sub_params.fast_start:
+            logging.debug(self.__class__.__name__ + " is initialized")
 
     def __del__(self):
         """
@@ -59,6 +105,10 @@ class Subscriber(ISubscribe):
             with self._send_reg_lock:
                 self._shape_types.append(shape)
             logging.debug(f"after add shape list is :{self._shape_types}")
+        if self._sub_is_running:
+            # like in Subscribe, do not wait for the next repetition
+            with self._send_reg_lock:
+                self._SendRegistrations(shapes)
         logging.info(f"adding shape: {shapes}")
 
     def Subscribe(self, publisher_port_num: int) -> None:
@@ -69,15 +119,33 @@ class Subscriber(ISubscribe):
         :param publisher_port_num:
         :return:None
         """
+        MyLogger.Init("myPubSub_logger", "../Log/sub.log")
         try:
-            self._mc_sock, self._publisher_address =\
-                Util.sock_init(Util.group_ip_publishers, publisher_port_num)
+            self._mc_sock = self._transport.Socket()
+            self._publisher_address = (Util.group_ip_publishers,
+                                       publisher_port_num)
             Util.SetSockToMulticast(self._mc_sock)
+            self._udp_sock.settimeout(Util.select_timeout)
+
+            # the first registration goes out right away, the thread
+            # only repeats it
+            with self._send_reg_lock:
+                self._SendRegistrations(self._shape_types)
+            logging.info(f"sent register request for {self._shape_types}")
 
             self._sub_is_running = True
+            if self._sub_params.discovery:
+                self._discovery_sock = self._transport.Socket()
+                Util.SetServerSockToMulticast(self._discovery_sock,
+                                              Util.discovery_port)
+                self._discovery_sock.settimeout(Util.announce_interval)
+                self._discovery_thread = threading.Thread(
+                    target=self._Discover, daemon=True)
+                self._discovery_thread.start()
             self._sub_is_sending_reg = True
             self._send_reg_thread.daemon = True
             self._send_reg_thread.start()
+            self._clock.Track(self._send_reg_thread)
 
             self._thread = threading.Thread(target=self._RecvMsgFromPub)
             self._thread.daemon = True  # thread will exit as soon the main dies
@@ -91,8 +159,26 @@ class Subscriber(ISubscribe):
     def Stop(self) -> None:
         self._sub_is_running = False  # set flag to signal thread to exit
         self._sub_is_sending_reg = False
-        self._thread.join(1)
-        self._send_reg_thread.join(1)
+        self._stop_event.set()
+        # wake the receiving threads instead of waiting for their timeout,
+        # a udp socket raises ENOTCONN but its reader still wakes up
+        for sock in (self._udp_sock, self._discovery_sock):
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+        # threads are not started when the subscriber never subscribed
+        if self._thread:
+            self._thread.join(1)
+        if self._send_reg_thread.is_alive():
+            self._send_reg_thread.join(1)
+        if self._discovery_thread:
+            self._discovery_thread.join(1)
+            self._discovery_sock.close()
+            self._discovery_thread = None
+        if self._capture:
+            self._capture.Close()
         logging.info("calling for threads out")
 
     def UnSubscribe(self,
@@ -111,6 +197,9 @@ class Subscriber(ISubscribe):
                 logging.debug(f"the last unsubscribe is with {list_to_unsub}")
             # Remove objects in list_to_unsub from _shape_types
             unsubscribed_shapes = []
+            # publishers picked by discovery, maybe on another port than
+            # the group, get the unregister as well
+            by_publisher: Dict[tuple, List[ShapeType]] = {}
             for shape in list(list_to_unsub):
                 try:
                     self._shape_types.remove(shape)
@@ -120,13 +209,23 @@ class Subscriber(ISubscribe):
                         f" list of shapes is {self._shape_types}")
                 except ValueError:
                     logging.error(f"failed to unsubscribe {shape} - not valid")
+                self._replay_pending.discard(shape)
+                current = self._current_pub.pop(shape, None)
+                if current is not None:
+                    by_publisher.setdefault(current, []).append(shape)
             self._sub_params.shape_types = unsubscribed_shapes
         Util.SendUnRegisterRequest(self._mc_sock, self._publisher_address,
                                    self._sub_params,
                                    self._udp_ip)
+        for addr, group in by_publisher.items():
+            Util.SendUnRegisterRequest(self._mc_sock, addr,
+                                       replace(self._sub_params,
+                                               shape_types=group),
+                                       self._udp_ip)
         logging.info(f"sent unregister request of"
                      f" {self._sub_params.shape_types}")
-        if not self._shape_types:  # check if _subscribed_objects is empty
+        # check if _subscribed_objects is empty
+        if not self._shape_types and self._stop_when_empty:
             self.Stop()
 
     def _RecvMsgFromPub(self) -> None:
@@ -138,40 +237,161 @@ class Subscriber(ISubscribe):
         Raises:
             OSError: If an error occurs while receiving the data.
         """
-        publishers_dict = {}
         while self._sub_is_running:
             try:
-                # Wait for the socket to be ready to read
-                ready, _, _ = select.select([self._udp_sock], [], [],
-                                            Util.select_timeout)
-                if not ready:
-                    continue
+                # the socket times out every select_timeout seconds
+                # so the running flag is checked
                 read_n_bytes, src_addr = \
-                    self._udp_sock.recvfrom(Util.max_buf_size)
+                    self._udp_sock.recvfrom(self._recv_buf_size)
                 if not read_n_bytes:
+                    if not self._sub_is_running:
+                        break  # woken up by Stop
                     raise RuntimeError("Failed to receive message")
-                data_str = read_n_bytes.decode('utf-8')
-                if data_str == 'ACK':
-                    logging.debug(f"Received data: {data_str},"
-                                  f" from: {src_addr}")
-                    publishers_dict =\
-                        self._RecAck(data_str, src_addr, publishers_dict)
-                # Parse the received data as JSON
-                # and deserialize it to a Shape object
-                else:
-                    shape_type, params = \
-                        Util.deserialize_shape(json.loads(
-                            data_str))
-
-                    recv_shape = \
-                        self._factory.create_shape(shape_type, params)
+                if self._capture:
+                    self._capture.Write(read_n_bytes, src_addr, time.time())
+                self._HandleDatagram(read_n_bytes, src_addr)
 
-                    # log the received shape data
-                    logging.info(f"Received shape: {recv_shape.print_shape()}")
+            except socket.timeout:
+                continue
 
             except Exception as e:
                 logging.error(f"Exception {e} caught in {__name__}")
 
+    # the receive pipeline, one method per stage so the replay driver
+    # (SUB/replay.py) can run and time each of them
+    def _HandleDatagram(self, datagram: bytes, src_addr: tuple) -> None:
+        """
+        process a datagram as read from the socket, one stage after the
+        other. the stages are separate methods so the replay driver runs
+        this very path while timing each of them
+        :param datagram: the datagram bytes
+        :param src_addr: address of the publisher
+        :return: None
+        """
+        datagram = self._Reassemble(datagram, src_addr)
+        if datagram is None:
+            return  # waiting for the rest of the fragments
+        datagram = self._Decompress(datagram, src_addr)
+        if datagram is None:
+            return
+        for message in self._Unbatch(datagram):
+            self._HandleMessage(message, src_addr)
+
+    def _Reassemble(self, datagram: bytes,
+                    src_addr: tuple) -> Optional[bytes]:
+        """
+        :param datagram: the datagram bytes, maybe a fragment
+        :param src_addr: address of the publisher
+        :return: the whole datagram, None while fragments are missing
+        """
+        return self._reassembler.Feed(datagram, src_addr)
+
+    def _Decompress(self, frame: bytes, src_addr: tuple) -> Optional[bytes]:
+        """
+        :param frame: a datagram, compressed or not
+        :param src_addr: address of the publisher
+        :return: the datagram, None if it cannot be decompressed
+        """
+        if not frame.startswith(COMPRESSED_MAGIC):
+            return frame
+        if self._sub_is_running and not self._sub_params.compression:
+            # never negotiated, a capture replay still decompresses
+            logging.warning(f"dropped compressed datagram from {src_addr}")
+            return None
+        try:
+            return self._decompressor.Decompress(frame)
+        except LookupError as e:
+            # a frame defining interned strings was lost, registering
+            # again tells the publisher what we know
+            logging.warning(f"{e}, dropped datagram from {src_addr}")
+            now = self._clock.Now()
+            if self._sub_is_running and (
+                    self._last_resync is None or
+                    now - self._last_resync > Util.select_timeout):
+                self._last_resync = now
+                with self._send_reg_lock:
+                    self._SendRegistrations(self._shape_types)
+        except ValueError as e:
+            logging.error(f"Exception {e} caught in {__name__}")
+        return None
+
+    @staticmethod
+    def _Unbatch(datagram: bytes) -> List[bytes]:
+        """
+        :param datagram: a whole datagram
+        :return: the messages it carries, a datagram may carry a batch
+        """
+        return Unpack(datagram)
+
+    def _HandleMessage(self, message: bytes, src_addr: tuple) -> None:
+        """
+        process a single message sent by a publisher
+        :param message: the message bytes
+        :param src_addr: address of the publisher
+        :return: None
+        """
+        try:
+            if message == b'ACK':
+                logging.debug(f"Received data: {message},"
+                              f" from: {src_addr}")
+                self._publishers_dict =\
+                    self._RecAck(message, src_addr, self._publishers_dict)
+            elif message == Util.shutdown_msg:
+                logging.warning(f"publisher {src_addr} is shutting down")
+                self._pub_table.Remove(src_addr)
+                self._CheckFailover()
+            # decode the received data, schema encoded or JSON,
+            # and deserialize it to a Shape object
+            else:
+                shape_type, params = self._DecodeMessage(message)
+                self._HandleShape(shape_type, params, src_addr)
+
+        except Exception as e:
+            logging.error(f"Exception {e} caught in {__name__}")
+
+    def _HandleShape(self, shape_type: int, params: List,
+                     src_addr: tuple) -> None:
+        """
+        process a decoded shape update
+        :param shape_type: type id of the shape
+        :param params: the shape params
+        :param src_addr: address of the publisher
+        :return: None
+        """
+        if not self._PruneStray(shape_type, src_addr):
+            return
+
+        recv_shape = self._CreateShape(shape_type, params)
+
+        self._Dispatch(recv_shape)
+
+    def _DecodeMessage(self, message: bytes) -> Tuple[int, List]:
+        """
+        :param message: an encoded shape message
+        :return: (shape type, params)
+        """
+        return Util.DecodeShape(message)
+
+    def _CreateShape(self, shape_type: int, params: List) -> Shape:
+        """
+        :param shape_type: type id of the shape
+        :param params: the shape params
+        :return: the shape built by the factory
+        """
+        return self._factory.create_shape(shape_type, params)
+
+    def _Dispatch(self, recv_shape: Shape) -> None:
+        """
+        hand the received shape to the user handler, or log it
+        :param recv_shape: the shape built by the factory
+        :return: None
+        """
+        if self._shape_handler:
+            self._shape_handler(recv_shape)
+        else:
+            # log the received shape data
+            logging.info(f"Received shape: {recv_shape.print_shape()}")
+
     @staticmethod
     def _RecAck(data_str, addr, publishers_dict) -> Dict:
         """
@@ -207,12 +427,132 @@ class Subscriber(ISubscribe):
         return publishers_dict
 
     def _SendReg(self):
-        # Send registration message to publisher
-        logging.info(f"sent register request for {self._shape_types}")
-        while self._sub_is_sending_reg:
+        # Repeat the registration message to publisher
+        while not self._clock.Wait(self._stop_event, Util.time_interval):
             with self._send_reg_lock:
                 self._sub_params.shape_types = self._shape_types
-                Util.SendRegisterRequest(self._mc_sock, self._publisher_address,
-                                         self._sub_params,
-                                         self._udp_ip)
-            time.sleep(Util.time_interval)
+                self._SendRegistrations(self._shape_types)
+
+    def _SendRegistrations(self, shapes: List[ShapeType]) -> None:
+        """
+        register the shapes with the publisher picked for each of them,
+        or with the multicast group when no publisher is known.
+        called with the send_reg_lock held
+        :param shapes: the shapes to register
+        :return: None
+        """
+        by_publisher: Dict[Tuple[tuple, bool], List[ShapeType]] = {}
+        for shape in shapes:
+            addr = self._current_pub.get(shape)
+            # with discovery every publisher of the group would replay
+            is_replay = shape in self._replay_pending and \
+                (addr is not None or not self._sub_params.discovery)
+            if is_replay:
+                self._replay_pending.discard(shape)
+            by_publisher.setdefault((addr or self._publisher_address,
+                                     is_replay), []).append(shape)
+        for (addr, is_replay), group in by_publisher.items():
+            params = replace(self._sub_params, shape_types=group)
+            if not is_replay:
+                params = replace(params, replay_from_seq=None,
+                                 replay_from_ts=None)
+            Util.SendRegisterRequest(self._mc_sock, addr, params,
+                                     self._udp_ip,
+                                     self._decompressor.Known()
+                                     if self._sub_params.compression
+                                     else None)
+
+    def _Discover(self) -> None:
+        """
+        listen to the publisher announcements and keep the publisher
+        table up to date, failing over as soon as a publisher goes silent
+        """
+        while self._sub_is_running:
+            try:
+                try:
+                    data, src_addr = self._discovery_sock.recvfrom(
+                        self._recv_buf_size)
+                except socket.timeout:
+                    data = None
+                if data:
+                    announce = Util.DeserializeJson(data.decode('utf-8'))
+                    if 'shutdown' in announce:
+                        addr = (src_addr[0], announce['shutdown'])
+                        logging.warning(f"publisher {addr} is shutting down")
+                        self._pub_table.Remove(addr)
+                    # a publisher on another port is not one we subscribed
+                    # to, e.g. the upstream publisher of a relay
+                    elif announce['announce'] == self._publisher_address[1]:
+                        addr = (src_addr[0], announce['announce'])
+                        if self._pub_table.Update(addr, announce['streams'],
+                                                  announce['load']):
+                            logging.info(f"discovered publisher {addr} of "
+                                         f"{announce['streams']}")
+                self._CheckFailover()
+
+            except Exception as e:
+                logging.error(f"Exception {e} caught in {__name__}")
+
+    def _CheckFailover(self) -> None:
+        """
+        make sure every subscribed shape is served by a live publisher,
+        registering right away with the next best one when it is not
+        """
+        with self._send_reg_lock:
+            changed = []
+            for shape in self._shape_types:
+                current = self._current_pub.get(shape)
+                if current is not None and self._pub_table.IsAlive(current):
+                    continue
+                best = self._pub_table.Best(shape)
+                if best == current:
+                    continue
+                if best is None:
+                    logging.error(f"Connection with {current} lost, no other"
+                                  f" publisher of {shape}")
+                    del self._current_pub[shape]
+                    continue
+                if current is None:
+                    logging.info(f"using publisher {best} for {shape}")
+                else:
+                    logging.warning(f"Connection with {current} lost, "
+                                    f"failing over to {best} for {shape}")
+                self._current_pub[shape] = best
+                changed.append(shape)
+            if changed:
+                self._SendRegistrations(changed)
+
+    def _PruneStray(self, shape_type: int, src_addr: tuple) -> bool:
+        """
+        unregister a shape from a live publisher other than the one picked
+        for it, e.g. one that got the multicast registration before
+        discovery picked a publisher, or from a publisher still sending a
+        shape that was unsubscribed
+        :param shape_type: the received shape
+        :param src_addr: the publisher that sent it
+        :return: False if the update is for a shape no longer subscribed
+        """
+        if not self._sub_is_running:
+            return True
+        is_subscribed = shape_type in self._shape_types
+        if is_subscribed:
+            current = self._current_pub.get(shape_type)
+            if current is None or current == src_addr or \
+                    not self._pub_table.IsAlive(src_addr):
+                return True
+        now = self._clock.Now()
+        key = (shape_type, src_addr)
+        if now - self._stray_unreg.get(key, 0.0) < Util.heartbeat_interval:
+            return is_subscribed
+        self._stray_unreg[key] = now
+        if is_subscribed:
+            logging.info(f"unregistering {shape_type} from {src_addr}, "
+                         f"served by {current}")
+        else:
+            logging.info(f"unregistering {shape_type} from {src_addr}, "
+                         f"no longer subscribed")
+        Util.SendUnRegisterRequest(self._mc_sock, src_addr,
+                                   replace(self._sub_params,
+                                           shape_types=[shape_type]),
+                                   self._udp_ip)
+        return is_subscribed
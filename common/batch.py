@@ -0,0 +1,244 @@
+import logging
+import struct
+import threading
+from typing import Callable, Dict, List, Optional
+from common.clock import RealClock
+from common.util import Priority, Util
+
+# a batch starts with this prefix followed by the number of messages,
+# each message is prefixed by its length
+BATCH_MAGIC = b'\xf0B'
+_HEADER = struct.Struct('!2sH')
+_LENGTH = struct.Struct('!H')
+
+
+class _Batch(object):
+    __slots__ = ('messages', 'expires', 'size', 'deadline', 'priority')
+
+    def __init__(self, deadline: float) -> None:
+        self.messages: List[bytes] = []
+        # when each message goes stale, None if it never does
+        self.expires: List[Optional[float]] = []
+        self.size = _HEADER.size
+        self.deadline = deadline
+        self.priority = Priority.BULK
+
+
+class Batcher(object):
+    """
+    Groups the messages bound for the same destination into one datagram.
+    A batch is sent once the next message would push it over the mtu, or
+    once its oldest message waited for the linger time. An urgent message
+    does not linger, it is sent right away with what is already pending
+    for its destination. Batches due together go out by priority, and the
+    messages that went stale while waiting are dropped.
+    """
+
+    def __init__(self, send_func: Callable[[bytes, tuple], None],
+                 mtu: int = Util.mtu,
+                 linger: float = Util.batch_linger,
+                 clock=None) -> None:
+        """
+        :param send_func: callable(datagram, destination) doing the actual send
+        :param mtu: biggest batch put on the wire
+        :param linger: seconds a message may wait for others to join it,
+                       0 sends every message right away
+        :param clock: time source, RealClock when None
+        """
+        self._clock = clock if clock else RealClock()
+        self._send_func = send_func
+        self._mtu = mtu
+        self._linger = linger
+        self._pending: Dict[tuple, _Batch] = {}
+        self._cond = threading.Condition()
+        self._is_running = False
+        self._thread: Optional[threading.Thread] = None
+        self._stats = {'dropped': 0}
+        # bumped whenever the flushing thread has something new to look
+        # at, and the last one it looked at
+        self._version = 0
+        self._seen_version = 0
+        self._is_sending = False
+        self._clock.AddIdleCheck(self.IsIdle)
+
+    def Start(self) -> None:
+        with self._cond:
+            if self._is_running or self._linger <= 0:
+                return
+            self._is_running = True
+        self._thread = threading.Thread(target=self._FlushLoop)
+        self._thread.daemon = True
+        self._thread.start()
+        self._clock.Track(self._thread)
+
+    def Stop(self) -> None:
+        """
+        stops the flushing thread and sends whatever is still pending
+        """
+        with self._cond:
+            self._is_running = False
+            self._version += 1
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(1)
+        self.Flush()
+
+    def Enqueue(self, message: bytes, dest: tuple,
+                priority: Priority = Priority.NORMAL,
+                expires: Optional[float] = None) -> None:
+        """
+        adds a message to the batch of its destination
+
+        :param message: encoded message
+        :param dest: (ip, port) of the receiver
+        :param priority: priority class of the stream, urgent messages are
+                         sent right away
+        :param expires: clock time after which the message is stale and
+                        dropped instead of sent, None for never
+        :return: None
+        """
+        item_size = _LENGTH.size + len(message)
+        if not self._is_running or \
+                _HEADER.size + item_size > self._mtu:
+            # can never share a datagram, let the send path deal with it
+            self._Send([message], dest)
+            return
+
+        full = None
+        urgent = None
+        with self._cond:
+            batch = self._pending.get(dest)
+            if batch is not None and batch.size + item_size > self._mtu:
+                full = self._pending.pop(dest)
+                batch = None
+            if batch is None:
+                batch = _Batch(self._clock.Now() + self._linger)
+                self._pending[dest] = batch
+                self._version += 1
+                self._cond.notify()
+            batch.messages.append(message)
+            batch.expires.append(expires)
+            batch.size += item_size
+            batch.priority = min(batch.priority, priority)
+            if priority == Priority.URGENT:
+                urgent = self._pending.pop(dest)
+        if full is not None:
+            self._SendBatch(full, dest)
+        if urgent is not None:
+            self._SendBatch(urgent, dest)
+
+    def Flush(self) -> None:
+        """
+        sends every pending batch right away
+        """
+        with self._cond:
+            pending, self._pending = self._pending, {}
+        for dest, batch in sorted(pending.items(),
+                                  key=lambda item: item[1].priority):
+            self._SendBatch(batch, dest)
+
+    def Stats(self) -> Dict[str, int]:
+        """
+        :return: number of stale messages dropped
+        """
+        with self._cond:
+            return dict(self._stats)
+
+    def IsIdle(self) -> bool:
+        """
+        :return: True when the flushing thread has nothing to react to
+                 before the time moves on
+        """
+        with self._cond:
+            return not self._is_running or \
+                (self._seen_version == self._version and
+                 not self._is_sending)
+
+    def _FlushLoop(self) -> None:
+        while True:
+            with self._cond:
+                if not self._is_running:
+                    return
+                self._seen_version = self._version
+                now = self._clock.Now()
+                due = [dest for dest, batch in self._pending.items()
+                       if batch.deadline <= now]
+                ready = sorted(((dest, self._pending.pop(dest))
+                                for dest in due),
+                               key=lambda item: (item[1].priority,
+                                                 item[1].deadline))
+                self._is_sending = bool(ready)
+                if not ready:
+                    timeout = min((batch.deadline for batch in
+                                   self._pending.values()), default=None)
+                    version = self._version
+                    self._clock.WaitCondition(
+                        self._cond, None if timeout is None else timeout - now,
+                        lambda: self._version != version)
+                    continue
+            for dest, batch in ready:
+                self._SendBatch(batch, dest)
+
+    def _SendBatch(self, batch: _Batch, dest: tuple) -> None:
+        now = self._clock.Now()
+        messages = [message for message, expires in
+                    zip(batch.messages, batch.expires)
+                    if expires is None or expires >= now]
+        if len(messages) < len(batch.messages):
+            logging.debug(f"dropping {len(batch.messages) - len(messages)} "
+                          f"stale messages to {dest}")
+            with self._cond:
+                self._stats['dropped'] += len(batch.messages) - len(messages)
+        if messages:
+            self._Send(messages, dest)
+
+    def _Send(self, messages: List[bytes], dest: tuple) -> None:
+        try:
+            self._send_func(Pack(messages), dest)
+        except Exception as e:
+            logging.error(f"Exception {e} caught while sending batch "
+                          f"to {dest}")
+
+
+def Pack(messages: List[bytes]) -> bytes:
+    """
+    frames the messages into a single datagram, a lone message is
+    left unframed
+
+    :param messages: encoded messages
+    :return: the datagram
+    """
+    if len(messages) == 1:
+        return messages[0]
+    parts = [_HEADER.pack(BATCH_MAGIC, len(messages))]
+    for message in messages:
+        parts.append(_LENGTH.pack(len(message)))
+        parts.append(message)
+    return b''.join(parts)
+
+
+def Unpack(datagram: bytes) -> List[bytes]:
+    """
+    splits a datagram back into its messages in a single pass
+
+    :param datagram: datagram as built by Pack
+    :return: list of the messages
+    :exception: ValueError if the batch is truncated
+    """
+    if not datagram.startswith(BATCH_MAGIC):
+        return [datagram]
+    try:
+        _, count = _HEADER.unpack_from(datagram)
+        offset = _HEADER.size
+        messages = []
+        for _ in range(count):
+            length, = _LENGTH.unpack_from(datagram, offset)
+            offset += _LENGTH.size
+            if offset + length > len(datagram):
+                raise ValueError("truncated batch")
+            messages.append(datagram[offset:offset + length])
+            offset += length
+    except struct.error:
+        # cut inside the header or a length prefix
+        raise ValueError("truncated batch")
+    return messages
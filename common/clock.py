@@ -0,0 +1,208 @@
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+
+class RealClock(object):
+    """
+    Wall clock time, what the library uses unless told otherwise.
+    """
+
+    @staticmethod
+    def Now() -> float:
+        return time.monotonic()
+
+    @staticmethod
+    def Event() -> threading.Event:
+        """
+        :return: an event the Wait method of this clock can wait for
+        """
+        return threading.Event()
+
+    @staticmethod
+    def Wait(event: threading.Event, timeout: Optional[float]) -> bool:
+        """
+        waits for the event or the timeout
+        :return: True if the event was set
+        """
+        return event.wait(timeout)
+
+    @staticmethod
+    def WaitCondition(cond: threading.Condition,
+                      timeout: Optional[float],
+                      predicate: Optional[Callable[[], bool]] = None) -> bool:
+        """
+        waits on a condition, its lock held by the caller
+        :param predicate: when given, waits until it is true
+        :return: False if the timeout expired
+        """
+        if predicate is None:
+            return cond.wait(timeout)
+        return cond.wait_for(predicate, timeout)
+
+    def AddIdleCheck(self, check: Callable[[], bool]) -> None:
+        pass
+
+    def Track(self, thread: threading.Thread) -> None:
+        pass
+
+
+class _ClockEvent(threading.Event):
+    """
+    An event waking up the threads waiting for it on a VirtualClock.
+    """
+
+    def __init__(self, clock: 'VirtualClock') -> None:
+        super().__init__()
+        self._clock = clock
+
+    def set(self) -> None:
+        super().set()
+        with self._clock._tick:
+            self._clock._tick.notify_all()
+
+
+class VirtualClock(object):
+    """
+    Time that only moves when Advance is called, for deterministic tests
+    and simulations. Advance returns once every thread waiting on the clock
+    is waiting again and every registered idle check passes, so the whole
+    system has reacted to the new time.
+    """
+
+    _POLL = 0.0005  # real seconds between checks while waiting
+
+    def __init__(self, start: float = 0.0,
+                 settle_timeout: float = 5.0) -> None:
+        """
+        :param start: initial virtual time
+        :param settle_timeout: real seconds Advance waits for the threads
+                               to settle before giving up
+        """
+        self._now = start
+        self._settle_timeout = settle_timeout
+        self._lock = threading.Lock()
+        # threads that ever waited on the clock, and the virtual deadline
+        # of the ones currently waiting (None for no deadline)
+        self._threads: Dict[int, threading.Thread] = {}
+        self._waiting: Dict[int, Optional[float]] = {}
+        self._idle_checks: List[Callable[[], bool]] = []
+        # notified whenever the time moves or a clock event is set
+        self._tick = threading.Condition()
+
+    def Now(self) -> float:
+        return self._now
+
+    def Event(self) -> threading.Event:
+        return _ClockEvent(self)
+
+    def Wait(self, event: threading.Event, timeout: Optional[float]) -> bool:
+        """
+        waits for the event or the virtual timeout, the event should come
+        from Event() or it is only noticed when the time moves
+        """
+        deadline = None if timeout is None else self._now + timeout
+        self._Enter(deadline)
+        try:
+            with self._tick:
+                while not event.is_set():
+                    if deadline is not None and self._now >= deadline:
+                        return False
+                    self._tick.wait()
+            return True
+        finally:
+            self._Leave()
+
+    def WaitCondition(self, cond: threading.Condition,
+                      timeout: Optional[float],
+                      predicate: Optional[Callable[[], bool]] = None) -> bool:
+        # the caller holds the lock of cond, so the deadline is polled. a
+        # notify racing with the end of a poll is lost, the predicate is
+        # what catches it
+        deadline = None if timeout is None else self._now + timeout
+        self._Enter(deadline)
+        try:
+            while predicate is None or not predicate():
+                if cond.wait(self._POLL) and predicate is None:
+                    break
+                if deadline is not None and self._now >= deadline:
+                    return False
+            return True
+        finally:
+            self._Leave()
+
+    def AddIdleCheck(self, check: Callable[[], bool]) -> None:
+        """
+        :param check: returns True when its component has nothing in flight
+        """
+        with self._lock:
+            self._idle_checks.append(check)
+
+    def Track(self, thread: threading.Thread) -> None:
+        """
+        counts a freshly started thread as running until it first waits on
+        the clock, so Advance does not run ahead of it
+        """
+        with self._lock:
+            self._threads[thread.ident] = thread
+
+    def Advance(self, seconds: float) -> None:
+        """
+        moves the time forward, stopping at every deadline on the way so
+        timers fire in order
+        :param seconds: virtual seconds to advance
+        """
+        target = self._now + seconds
+        self.Settle()
+        while True:
+            with self._lock:
+                deadlines = [deadline for deadline in self._waiting.values()
+                             if deadline is not None and
+                             self._now < deadline <= target]
+            if not deadlines:
+                break
+            self._SetNow(min(deadlines))
+            self.Settle()
+        self._SetNow(target)
+        self.Settle()
+
+    def Settle(self) -> None:
+        """
+        blocks until every clock thread waits for a future time and every
+        idle check passes
+        :exception: RuntimeError if it does not happen in settle_timeout
+        """
+        give_up = time.monotonic() + self._settle_timeout
+        while not self._IsSettled():
+            if time.monotonic() > give_up:
+                raise RuntimeError("virtual clock threads did not settle")
+            time.sleep(self._POLL)
+
+    def _SetNow(self, now: float) -> None:
+        with self._tick:
+            self._now = now
+            self._tick.notify_all()
+
+    def _IsSettled(self) -> bool:
+        with self._lock:
+            for ident, thread in list(self._threads.items()):
+                if not thread.is_alive():
+                    del self._threads[ident]
+                    continue
+                if ident not in self._waiting:
+                    return False  # running
+                deadline = self._waiting[ident]
+                if deadline is not None and deadline <= self._now:
+                    return False  # about to wake up
+            checks = list(self._idle_checks)
+        return all(check() for check in checks)
+
+    def _Enter(self, deadline: Optional[float]) -> None:
+        ident = threading.get_ident()
+        with self._lock:
+            self._threads[ident] = threading.current_thread()
+            self._waiting[ident] = deadline
+
+    def _Leave(self) -> None:
+        with self._lock:
+            self._waiting.pop(threading.get_ident(), None)
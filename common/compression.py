@@ -0,0 +1,251 @@
+import random
+import re
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from common.util import Util
+
+# a compressed datagram: this prefix, the session of the compressor, the
+# id of the first string defined in the frame and the number of strings
+# defined, the definitions (length prefixed), then the deflated payload
+COMPRESSED_MAGIC = b'\xf0Z'
+_HEADER = struct.Struct('!2sHBB')
+_LENGTH = struct.Struct('!B')
+
+# in the payload, an interned string becomes _ESCAPE followed by its id
+# (0x80 + index), a literal _ESCAPE byte becomes _ESCAPE _LITERAL. only
+# ascii strings are interned, so a string never overlaps an id
+_ESCAPE = b'\xf1'
+_LITERAL = b'\xff'
+_FIRST_ID = 0x80
+MAX_INTERNED = 0xff - _FIRST_ID
+_REFERENCE = re.compile(re.escape(_ESCAPE) + b'(.)', re.DOTALL)
+
+# small window and memory level, payloads are at most an mtu or so
+_WBITS = -12
+_MEM_LEVEL = 4
+
+# deflate may copy from this as if it preceded every payload. the most
+# common bytes go last, where the references are the cheapest
+PRESET_DICTIONARY = (
+    b'orangepurplebrowngreyblackwhiteyellowgreenbluered'
+    b'\xf0B\x00\x02\x00\x1d\xf0S\x00\x03\x01\xf0S\x00\x02\x01\xf0S\x00\x01\x01'
+    b'"]}{"type": 3, "params": [{"type": 2, "params": ['
+    b'{"type": 1, "params": [')
+
+
+class Compressor(object):
+    """
+    Publisher side of the compression. Datagrams sent to a destination
+    that negotiated compression are interned and deflated, and sent
+    compressed only when that makes them smaller. The interned strings
+    are defined once per destination, in the first frame sent after they
+    were interned; a destination reporting fewer known strings gets them
+    again.
+    """
+
+    def __init__(self, level: int = Util.compression_level) -> None:
+        """
+        :param level: zlib compression level
+        """
+        # tells apart the tables of two runs of a publisher
+        self._session = random.getrandbits(16)
+        self._strings: List[bytes] = []
+        self._ids: Dict[bytes, bytes] = {}
+        self._pattern: Optional['re.Pattern'] = None
+        # number of strings every destination knows
+        self._known: Dict[tuple, int] = {}
+        self._lock = threading.Lock()
+        self._base = zlib.compressobj(level, zlib.DEFLATED, _WBITS,
+                                      _MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY,
+                                      PRESET_DICTIONARY)
+        self._stats = {'bytes_in': 0, 'bytes_out': 0}
+
+    def Open(self, dest: tuple, known: Dict[str, int]) -> None:
+        """
+        compresses what is sent to a destination from now on
+
+        :param dest: (ip, port) of the subscriber
+        :param known: strings the subscriber knows, per session, as
+                      reported in its registration
+        :return: None
+        """
+        with self._lock:
+            self._known[dest] = max(0, min(known.get(str(self._session), 0),
+                                           len(self._strings)))
+
+    def Close(self, dest: tuple) -> None:
+        with self._lock:
+            self._known.pop(dest, None)
+
+    def HasSessions(self) -> bool:
+        return bool(self._known)
+
+    def Intern(self, value: str) -> None:
+        """
+        adds a string that keeps appearing in the messages, e.g. a color,
+        to the strings replaced by a small id
+        """
+        data = value.encode('utf-8')
+        if data in self._ids:
+            return
+        with self._lock:
+            if data in self._ids or not 1 < len(data) < 256 or \
+                    not value.isascii() or \
+                    len(self._strings) >= MAX_INTERNED:
+                return
+            self._ids[data] = _ESCAPE + bytes((_FIRST_ID +
+                                               len(self._strings),))
+            self._strings.append(data)
+            # longest first, so a string containing another one wins
+            self._pattern = re.compile(b'|'.join(
+                re.escape(string) for string in
+                sorted(self._strings, key=len, reverse=True)))
+
+    def Compress(self, payload: bytes, dest: tuple) -> bytes:
+        """
+        :param payload: a datagram about to be sent, any bytes-like object,
+                        e.g. a memoryview of the journal
+        :param dest: (ip, port) of the subscriber
+        :return: the compressed frame, or the payload itself when the
+                 destination did not ask for compression or the frame
+                 would not be smaller
+        """
+        with self._lock:
+            known = self._known.get(dest)
+            # the subscriber rejects frames expanding beyond a datagram
+            if known is None or len(payload) > Util.max_buf_size:
+                return payload
+            pattern, ids = self._pattern, self._ids
+            new_strings = self._strings[known:]
+            compressobj = self._base.copy()
+        body = bytes(payload).replace(_ESCAPE, _ESCAPE + _LITERAL)
+        if pattern is not None:
+            body = pattern.sub(lambda match: ids[match.group()], body)
+        parts = [_HEADER.pack(COMPRESSED_MAGIC, self._session, known,
+                              len(new_strings))]
+        for string in new_strings:
+            parts.append(_LENGTH.pack(len(string)))
+            parts.append(string)
+        parts.append(compressobj.compress(body))
+        parts.append(compressobj.flush())
+        frame = b''.join(parts)
+        with self._lock:
+            self._stats['bytes_in'] += len(payload)
+            # a frame defining strings is the announcement of the session,
+            # it is sent even when bigger since the next ones pay it back
+            if not new_strings and len(frame) >= len(payload):
+                self._stats['bytes_out'] += len(payload)
+                return payload
+            self._stats['bytes_out'] += len(frame)
+            if dest in self._known:
+                self._known[dest] = max(self._known[dest],
+                                        known + len(new_strings))
+        return frame
+
+    def Stats(self) -> Dict[str, int]:
+        """
+        :return: bytes handed to Compress and bytes it returned
+        """
+        with self._lock:
+            return dict(self._stats)
+
+
+class Decompressor(object):
+    """
+    Subscriber side of the compression, keeps the strings defined by the
+    last few publisher sessions.
+    """
+
+    def __init__(self, max_sessions: int = 8,
+                 max_size: int = Util.max_buf_size) -> None:
+        """
+        :param max_sessions: sessions whose strings are kept, the least
+                             recently used are forgotten
+        :param max_size: bytes a frame may expand to, bigger ones are
+                         rejected before they are inflated any further
+        """
+        self._max_sessions = max_sessions
+        self._max_size = max_size
+        self._tables: 'OrderedDict[int, List[bytes]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._base = zlib.decompressobj(_WBITS, PRESET_DICTIONARY)
+
+    def Known(self) -> Dict[str, int]:
+        """
+        :return: the number of strings known per session, reported to the
+                 publishers when registering
+        """
+        with self._lock:
+            return {str(session): len(table)
+                    for session, table in self._tables.items()}
+
+    def Decompress(self, frame: bytes) -> bytes:
+        """
+        :param frame: a frame built by Compressor.Compress
+        :return: the original payload
+        :exception: LookupError when strings defined by a lost frame are
+                    missing, ValueError when the frame is corrupt
+        """
+        try:
+            _, session, first, count = _HEADER.unpack_from(frame)
+        except struct.error:
+            raise ValueError("truncated compressed frame")
+        offset = _HEADER.size
+        strings = []
+        for _ in range(count):
+            if offset >= len(frame) or \
+                    offset + _LENGTH.size + frame[offset] > len(frame):
+                raise ValueError("truncated string definitions")
+            length, = _LENGTH.unpack_from(frame, offset)
+            offset += _LENGTH.size
+            strings.append(frame[offset:offset + length])
+            offset += length
+        with self._lock:
+            table = self._tables.get(session)
+            if table is None:
+                table = self._tables[session] = []
+                if len(self._tables) > self._max_sessions:
+                    self._tables.popitem(last=False)
+            else:
+                self._tables.move_to_end(session)
+            if first > len(table):
+                raise LookupError(f"strings {len(table)} to {first - 1} of "
+                                  f"session {session} are missing")
+            if strings:
+                del table[first:]
+                table.extend(strings)
+            table = list(table)
+            decompressobj = self._base.copy()
+        try:
+            body = decompressobj.decompress(frame[offset:], self._max_size)
+        except zlib.error as e:
+            raise ValueError(f"corrupt compressed frame: {e}")
+        if decompressobj.unconsumed_tail:
+            raise ValueError(f"compressed frame expands beyond "
+                             f"{self._max_size} bytes")
+        # every frame is a finished deflate stream
+        if not decompressobj.eof:
+            raise ValueError("truncated compressed frame")
+
+        size = len(body)
+
+        def Expand(match) -> bytes:
+            nonlocal size
+            code = match.group(1)
+            if code == _LITERAL:
+                size -= 1
+                return _ESCAPE
+            index = code[0] - _FIRST_ID
+            if not 0 <= index < len(table):
+                raise LookupError(f"string {index} of session {session} "
+                                  f"is missing")
+            size += len(table[index]) - 2
+            if size > self._max_size:
+                raise ValueError(f"compressed frame expands beyond "
+                                 f"{self._max_size} bytes")
+            return table[index]
+
+        return _REFERENCE.sub(Expand, body)
@@ -0,0 +1,163 @@
+import itertools
+import logging
+import struct
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+from common.clock import RealClock
+from common.util import Util
+
+# every fragment starts with this prefix, a json message starts with '{'
+# and an ack with 'A' so the receiver can tell them apart by the first bytes
+FRAGMENT_MAGIC = b'\xf0F'
+# magic, sequence, fragment index, fragment count
+_HEADER = struct.Struct('!2sIHH')
+
+
+class Fragmenter(object):
+    """
+    Splits payloads that do not fit in a single datagram into
+    MTU-sized fragments.
+    """
+
+    def __init__(self, mtu: int = Util.mtu) -> None:
+        """
+        :param mtu: maximal size in bytes of a datagram put on the wire
+        """
+        if mtu <= _HEADER.size:
+            raise ValueError(f"mtu must be bigger than {_HEADER.size}")
+        self._mtu = mtu
+        self._chunk_size = mtu - _HEADER.size
+        # next() on itertools.count is atomic, so the fragmenter can be shared
+        # between the publishing threads without a lock
+        self._sequence = itertools.count()
+
+    def Fragment(self, payload: bytes) -> List[bytes]:
+        """
+        split the payload into datagrams no bigger than the mtu.
+        a payload that already fits is returned as is, without a header.
+
+        :param payload: the encoded message
+        :return: list of datagrams to send in order
+        """
+        if len(payload) <= self._mtu:
+            return [payload]
+
+        count = -(-len(payload) // self._chunk_size)
+        if count > 0xFFFF:
+            raise ValueError(f"payload of {len(payload)} bytes is too big")
+        sequence = next(self._sequence) & 0xFFFFFFFF
+        chunk = self._chunk_size
+        return [_HEADER.pack(FRAGMENT_MAGIC, sequence, index, count) +
+                payload[index * chunk:(index + 1) * chunk]
+                for index in range(count)]
+
+
+class _PendingMessage(object):
+    __slots__ = ('chunks', 'received', 'size', 'first_seen')
+
+    def __init__(self, count: int, first_seen: float) -> None:
+        self.chunks: List[Optional[bytes]] = [None] * count
+        self.received = 0
+        self.size = 0
+        self.first_seen = first_seen
+
+
+class Reassembler(object):
+    """
+    Collects fragments produced by a Fragmenter back into whole messages.
+    Messages are keyed by (sender address, sequence). incomplete messages
+    are dropped once they are older than the timeout, or when the memory
+    budget is exceeded (oldest first).
+    A reassembler is owned by a single receiving thread.
+    """
+
+    def __init__(self, timeout: float = Util.reassembly_timeout,
+                 max_pending_bytes: int = Util.reassembly_budget,
+                 clock=None) -> None:
+        """
+        :param timeout: seconds to wait for the missing fragments of a message
+        :param max_pending_bytes: bound on the bytes held by incomplete
+                                  messages
+        :param clock: time source of the timeout, RealClock when None
+        """
+        self._clock = clock if clock else RealClock()
+        self._timeout = timeout
+        self._max_pending_bytes = max_pending_bytes
+        self._pending_bytes = 0
+        # insertion ordered, so the oldest message is always first
+        self._pending: "OrderedDict[Tuple[tuple, int], _PendingMessage]" = \
+            OrderedDict()
+
+    def Feed(self, datagram: bytes, src_addr: tuple) -> Optional[bytes]:
+        """
+        feed a received datagram.
+
+        :param datagram: the bytes read from the socket
+        :param src_addr: address of the sender
+        :return: the whole message once complete, None while it is
+                 still missing fragments
+        """
+        if not datagram.startswith(FRAGMENT_MAGIC):
+            return datagram
+        if len(datagram) < _HEADER.size:
+            logging.warning(f"dropping short fragment from {src_addr}")
+            return None
+
+        _, sequence, index, count = _HEADER.unpack_from(datagram)
+        if not count or index >= count:
+            logging.warning(f"dropping malformed fragment from {src_addr}")
+            return None
+
+        now = self._clock.Now()
+        self._Expire(now)
+
+        key = (src_addr, sequence)
+        pending = self._pending.get(key)
+        if pending is None:
+            if count == 1:
+                return datagram[_HEADER.size:]
+            pending = _PendingMessage(count, now)
+            self._pending[key] = pending
+        elif len(pending.chunks) != count:
+            logging.warning(f"fragment count mismatch from {src_addr}")
+            self._Drop(key)
+            return None
+
+        if pending.chunks[index] is not None:
+            return None  # duplicate
+        chunk = datagram[_HEADER.size:]
+        pending.chunks[index] = chunk
+        pending.received += 1
+        pending.size += len(chunk)
+        self._pending_bytes += len(chunk)
+
+        if pending.received == count:
+            self._Drop(key)
+            return b''.join(pending.chunks)
+
+        self._Evict()
+        return None
+
+    def PendingBytes(self) -> int:
+        return self._pending_bytes
+
+    def _Drop(self, key: Tuple[tuple, int]) -> None:
+        pending = self._pending.pop(key)
+        self._pending_bytes -= pending.size
+
+    def _Expire(self, now: float) -> None:
+        while self._pending:
+            key, pending = next(iter(self._pending.items()))
+            if now - pending.first_seen < self._timeout:
+                break
+            logging.warning(f"incomplete message {key} timed out after "
+                            f"{pending.received}/{len(pending.chunks)} "
+                            f"fragments")
+            self._Drop(key)
+
+    def _Evict(self) -> None:
+        while self._pending_bytes > self._max_pending_bytes and self._pending:
+            key = next(iter(self._pending))
+            logging.warning(f"reassembly budget exceeded, dropping {key}")
+            self._Drop(key)
+
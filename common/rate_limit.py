@@ -0,0 +1,66 @@
+import threading
+from common.clock import RealClock
+
+# tokens short after waiting exactly the refill time, only rounding. on a
+# virtual clock the time would not move on to make up for them
+_EPSILON = 1e-9
+
+
+class TokenBucket(object):
+    """
+    Classic token bucket, refilled continuously at `rate` tokens per second
+    up to `burst` tokens.
+    """
+
+    def __init__(self, rate: float, burst: float, clock=None) -> None:
+        """
+        :param rate: tokens added per second
+        :param burst: maximal number of tokens saved up
+        :param clock: time source of the refill, RealClock when None
+        """
+        self._clock = clock if clock else RealClock()
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._last = self._clock.Now()
+        # waited on when Acquire has no stop event, never set
+        self._never = self._clock.Event()
+        self._lock = threading.Lock()
+
+    def TryAcquire(self, tokens: float = 1) -> bool:
+        """
+        :param tokens: tokens needed
+        :return: True if the tokens were taken, False if there are not enough
+        """
+        with self._lock:
+            self._Refill()
+            if self._tokens + _EPSILON < tokens:
+                return False
+            self._tokens -= tokens
+            return True
+
+    def Acquire(self, tokens: float = 1,
+                stop_event: threading.Event = None) -> bool:
+        """
+        blocks until the tokens are available
+
+        :param tokens: tokens needed
+        :param stop_event: gives up waiting once set
+        :return: True if the tokens were taken, False if stopped
+        """
+        while True:
+            with self._lock:
+                self._Refill()
+                if self._tokens + _EPSILON >= tokens:
+                    self._tokens -= tokens
+                    return True
+                wait = (tokens - self._tokens) / self._rate
+            if self._clock.Wait(stop_event if stop_event is not None
+                                else self._never, wait):
+                return False
+
+    def _Refill(self) -> None:
+        now = self._clock.Now()
+        self._tokens = min(self._burst,
+                           self._tokens + (now - self._last) * self._rate)
+        self._last = now
@@ -0,0 +1,188 @@
+import itertools
+import socket
+import threading
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+from common.util import Util
+
+
+class UdpTransport(object):
+    """
+    Real UDP sockets, the default transport of publishers and subscribers.
+    """
+
+    @staticmethod
+    def Socket() -> socket.socket:
+        return socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                             socket.IPPROTO_UDP)
+
+    @staticmethod
+    def LocalIp(fast_start: bool = False) -> str:
+        """
+        :param fast_start: find the interface without a DNS lookup
+        :return: the address a subscriber binds to
+        """
+        if fast_start:
+            return Util.GetLocalIp()
+        return socket.gethostbyname(socket.gethostname())
+
+
+class LoopbackSocket(object):
+    """
+    Implements the part of the socket API the library uses, on top of
+    in-process queues. Multicast membership is taken from setsockopt
+    (IP_ADD_MEMBERSHIP), so the Util socket helpers work unchanged.
+    """
+
+    def __init__(self, network: 'LoopbackNetwork') -> None:
+        self._network = network
+        self._queue: Deque[Tuple[bytes, tuple]] = deque()
+        self._cond = threading.Condition()
+        self._timeout: Optional[float] = None
+        self._is_shut = False
+        self._is_reading = False
+        self._has_reader = False
+        self.addr: Optional[tuple] = None
+        self.groups: List[str] = []
+
+    # socket API
+    def bind(self, addr: tuple) -> None:
+        self._network.Bind(self, addr)
+
+    def sendto(self, data: bytes, addr: tuple) -> int:
+        if self.addr is None:
+            self._network.Bind(self, (Util.loopback_ip, 0))
+        self._network.Deliver(bytes(data), self.addr, addr)
+        return len(data)
+
+    def recvfrom(self, buf_size: int) -> Tuple[bytes, tuple]:
+        with self._cond:
+            self._has_reader = True
+            self._is_reading = True
+            try:
+                if not self._queue and not self._is_shut:
+                    if not self._cond.wait_for(
+                            lambda: self._queue or self._is_shut,
+                            self._timeout):
+                        raise socket.timeout("timed out")
+                if not self._queue:
+                    return b'', None
+                data, src_addr = self._queue.popleft()
+            finally:
+                self._is_reading = False
+        # a datagram bigger than the buffer is truncated, as with udp
+        return data[:buf_size], src_addr
+
+    def setsockopt(self, level: int, option: int, value) -> None:
+        if level == socket.IPPROTO_IP and \
+                option == socket.IP_ADD_MEMBERSHIP:
+            self.groups.append(socket.inet_ntoa(value[:4]))
+
+    def settimeout(self, timeout: Optional[float]) -> None:
+        self._timeout = timeout
+
+    def getsockname(self) -> tuple:
+        return self.addr if self.addr else ('0.0.0.0', 0)
+
+    def shutdown(self, how: int) -> None:
+        with self._cond:
+            self._is_shut = True
+            self._cond.notify_all()
+
+    def close(self) -> None:
+        self.shutdown(socket.SHUT_RDWR)
+        self._network.Unbind(self)
+
+    # loopback internals
+    def Push(self, data: bytes, src_addr: tuple) -> None:
+        with self._cond:
+            if self._is_shut:
+                return
+            self._queue.append((data, src_addr))
+            self._cond.notify()
+
+    def IsIdle(self) -> bool:
+        """
+        nothing queued and the reader, if any, back in recvfrom
+        """
+        with self._cond:
+            if not self._has_reader:
+                return True
+            return not self._queue and (self._is_reading or self._is_shut)
+
+
+class LoopbackNetwork(object):
+    """
+    An in-process network shared by the publishers and subscribers of a
+    test, replacing the kernel. Datagrams are never lost or reordered.
+    """
+
+    def __init__(self) -> None:
+        self._ports: Dict[int, List[LoopbackSocket]] = {}
+        self._ephemeral = itertools.count(49152)
+        self._lock = threading.Lock()
+
+    def Bind(self, sock: LoopbackSocket, addr: tuple) -> None:
+        ip, port = addr
+        with self._lock:
+            if not port:
+                port = next(self._ephemeral)
+                while port in self._ports:
+                    port = next(self._ephemeral)
+            sock.addr = (ip or Util.loopback_ip, port)
+            self._ports.setdefault(port, []).append(sock)
+
+    def Unbind(self, sock: LoopbackSocket) -> None:
+        with self._lock:
+            if sock.addr and sock in self._ports.get(sock.addr[1], []):
+                self._ports[sock.addr[1]].remove(sock)
+
+    def Deliver(self, data: bytes, src_addr: tuple, dest: tuple) -> None:
+        ip, port = dest
+        with self._lock:
+            bound = list(self._ports.get(port, []))
+        if _IsMulticast(ip):
+            receivers = [sock for sock in bound if ip in sock.groups]
+        else:
+            # like the kernel, a unicast datagram reaches one socket
+            receivers = bound[-1:]
+        for sock in receivers:
+            sock.Push(data, src_addr)
+
+    def IsIdle(self) -> bool:
+        """
+        :return: True when every datagram sent was read and handled
+        """
+        with self._lock:
+            sockets = [sock for socks in self._ports.values()
+                       for sock in socks]
+        return all(sock.IsIdle() for sock in sockets)
+
+
+class LoopbackTransport(object):
+    """
+    Transport handing out sockets of a LoopbackNetwork.
+    """
+
+    def __init__(self, network: Optional[LoopbackNetwork] = None,
+                 clock=None) -> None:
+        """
+        :param network: network shared with the other transports of the test
+        :param clock: a VirtualClock that should wait for the network to
+                      drain before the time moves on
+        """
+        self.network = network if network else LoopbackNetwork()
+        if clock is not None:
+            clock.AddIdleCheck(self.network.IsIdle)
+
+    def Socket(self) -> LoopbackSocket:
+        return LoopbackSocket(self.network)
+
+    @staticmethod
+    def LocalIp(fast_start: bool = False) -> str:
+        return Util.loopback_ip
+
+
+def _IsMulticast(ip: str) -> bool:
+    first_octet = ip.split('.', 1)[0]
+    return first_octet.isdigit() and 224 <= int(first_octet) <= 239
@@ -1,9 +1,19 @@
+import functools
 import json
+import logging
 import socket
 import struct
 from dataclasses import dataclass
-from typing import Tuple, Dict
-from data.factory_shape import *
+from enum import IntEnum
+from typing import Tuple, Dict, Optional, Callable, List
+from data.factory_shape import ShapeType
+from data.schema import SCHEMA_MAGIC, registry
+
+
+class Priority(IntEnum):
+    URGENT = 0  # always sent first
+    NORMAL = 1
+    BULK = 2
 
 
 @dataclass
@@ -11,12 +21,39 @@ class PublisherParams:
     shape_type: ShapeType
     freq: int
     params: list
+    priority: Priority = Priority.NORMAL
+    # share of the send thread within the priority class,
+    # Util.priority_weights of the class when None
+    weight: Optional[int] = None
+    # seconds after which a non urgent update is dropped unsent
+    deadline: Optional[float] = None
 
 
 @dataclass
 class SubscriberParams:
     shape_types: List[ShapeType]
     subscriber_udp_recv_port_num: int
+    # bytes read per recvfrom, defaults to Util.max_buf_size
+    recv_buf_size: Optional[int] = None
+    # kernel receive buffer (SO_RCVBUF), system default when None
+    sock_rcvbuf: Optional[int] = None
+    # ask the publisher to replay its journal from a sequence number
+    # or a timestamp (seconds since epoch) when registering
+    replay_from_seq: Optional[int] = None
+    replay_from_ts: Optional[float] = None
+    # called with every received shape instead of logging it
+    shape_handler: Optional[Callable] = None
+    # record the raw received datagrams into this file, see SUB/capture.py
+    capture_path: Optional[str] = None
+    # listen to publisher announcements and register with the least loaded
+    # publisher of each shape, failing over when it goes silent
+    discovery: bool = True
+    # bind to the interface routing to the publishers instead of resolving
+    # the host name, which may block on DNS
+    fast_start: bool = False
+    # ask the publishers to compress what they send us, worth it on
+    # metered links, see common/compression.py
+    compression: bool = False
 
 
 class Util(object):
@@ -26,7 +63,47 @@ class Util(object):
     """
 
     group_ip_publishers = '239.255.0.1'
-    max_buf_size = 1024
+    loopback_ip = '127.0.0.1'
+    # largest udp datagram, so a read is never truncated
+    max_buf_size = 65535
+    # largest datagram we put on the wire, bigger messages are fragmented
+    mtu = 1400
+    # seconds to wait for the missing fragments of a message
+    reassembly_timeout = 2.0
+    # bytes that incomplete messages may hold per receiver
+    reassembly_budget = 4 * 1024 * 1024
+    # seconds an update may wait for others bound to the same subscriber
+    batch_linger = 0.005
+    # journal of the published messages, see PUB/journal.py
+    journal_segment_size = 4 * 1024 * 1024
+    journal_retention_seconds = 60 * 60
+    journal_retention_bytes = 256 * 1024 * 1024
+    # messages per second (and burst) a replay may send to a subscriber
+    replay_rate = 500
+    replay_burst = 50
+    # publishers announce themselves on this port of the multicast group
+    discovery_port = 4546
+    announce_interval = 0.5
+    # a publisher not heard for that long is considered dead
+    heartbeat_interval = 1.5
+    # default weight of the streams of each priority class
+    priority_weights = {Priority.URGENT: 1, Priority.NORMAL: 4,
+                        Priority.BULK: 1}
+    # seconds Stop waits for each worker of the publisher
+    drain_timeout = 2.0
+    # sent by a stopping publisher to its subscribers
+    shutdown_msg = b'BYE'
+    # control port admission, see PUB/admission.py: requests bigger than
+    # that are dropped unparsed, every host may send request_rate
+    # requests per second (and a burst), enough for a few dozen
+    # subscribers, at most request_queue_size requests wait to be handled
+    max_request_size = 512
+    request_rate = 50
+    request_burst = 200
+    request_queue_size = 1024
+    max_request_sources = 4096
+    # zlib level of the compressed datagrams, see common/compression.py
+    compression_level = 9
     time_interval = 10
     select_timeout = 3
     threshold = 3
@@ -61,15 +138,54 @@ class Util(object):
         }
         return json.dumps(message)
 
+    @staticmethod
+    def EncodeShape(shape_type: ShapeType, params: List,
+                    schema_version: Optional[int] = None) -> bytes:
+        """
+        encode the publisher's shape notice with the negotiated schema
+        version, or as json when none was negotiated or the params do not
+        fit the schema (a float height, a long color...), every subscriber
+        decodes json
+
+        :param shape_type: type id of the shape
+        :param params: shape params in schema order
+        :param schema_version: negotiated version, None for json
+        :return: the encoded message
+        """
+        if schema_version is not None:
+            codec = registry.Codec(shape_type, schema_version)
+            if codec is not None:
+                try:
+                    return codec.Encode(params)
+                except ValueError as e:
+                    logging.debug(f"sending {shape_type} as json: {e}")
+        return Util.Serialize(shape_type, params).encode('utf-8')
+
+    @staticmethod
+    def DecodeShape(message: bytes) -> Tuple[int, List]:
+        """
+        decode a shape notice encoded by EncodeShape
+
+        :param message: the received message
+        :return: (type id, params)
+        """
+        if message.startswith(SCHEMA_MAGIC):
+            return registry.Decode(message)
+        return Util.deserialize_shape(json.loads(message.decode('utf-8')))
+
     @staticmethod
     def SendRegisterRequest(sock_fd: socket,
                             publisher_address: tuple,
                             sub_params: SubscriberParams,
-                            subscriber_udp_recv_ip) -> None:
+                            subscriber_udp_recv_ip,
+                            compression: Optional[Dict[str, int]] = None
+                            ) -> None:
         """
         send the register request/requests to the publisher
         according to amount of shapes
         :param subscriber_udp_recv_ip: ip of the client
+        :param compression: when compression is asked for, the number of
+                            interned strings known per publisher session
         :param sock_fd: subscriber active socket
         :param publisher_address: where to send
         :param sub_params: subscriber adjustable params
@@ -79,7 +195,15 @@ class Util(object):
             json_message = {"request": "register",
                             "shape": shape_type,
                             "udp_port": sub_params.subscriber_udp_recv_port_num,
-                            "udp_ip": subscriber_udp_recv_ip}
+                            "udp_ip": subscriber_udp_recv_ip,
+                            # newest schema version we can decode
+                            "schema": registry.LatestVersion(shape_type)}
+            if sub_params.replay_from_seq is not None:
+                json_message["replay_seq"] = sub_params.replay_from_seq
+            elif sub_params.replay_from_ts is not None:
+                json_message["replay_ts"] = sub_params.replay_from_ts
+            if compression is not None:
+                json_message["compression"] = compression
             message = json.dumps(json_message).encode()
             try:
                 sock_fd.sendto(message, publisher_address)
@@ -115,6 +239,53 @@ class Util(object):
                 sock_fd.close()
                 return
 
+    @staticmethod
+    def SendAnnouncement(sock_fd: socket,
+                         publisher_port_num: int,
+                         streams: List[ShapeType],
+                         load: int) -> None:
+        """
+        announce a publisher to the subscribers listening for discovery
+        :param sock_fd: publisher socket to send from
+        :param publisher_port_num: port the publisher takes registrations on
+        :param streams: shape types the publisher offers
+        :param load: load figure of the publisher, lower is better
+        :return:None
+        """
+        json_message = {"announce": publisher_port_num,
+                        "streams": streams,
+                        "load": load}
+        sock_fd.sendto(json.dumps(json_message).encode(),
+                       (Util.group_ip_publishers, Util.discovery_port))
+
+    @staticmethod
+    def SendShutdownNotice(sock_fd: socket, publisher_port_num: int) -> None:
+        """
+        tell the subscribers listening for discovery that a publisher stops
+        :param sock_fd: publisher socket to send from
+        :param publisher_port_num: port the publisher takes registrations on
+        :return:None
+        """
+        json_message = {"shutdown": publisher_port_num}
+        sock_fd.sendto(json.dumps(json_message).encode(),
+                       (Util.group_ip_publishers, Util.discovery_port))
+
+    @staticmethod
+    def GetLocalIp() -> str:
+        """
+        the address of the interface that routes to the publishers group,
+        found without any DNS lookup. connecting a udp socket sends nothing.
+        :return: ip address, the loopback address if there is no route
+        """
+        sock_fd = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock_fd.connect((Util.group_ip_publishers, Util.discovery_port))
+            return sock_fd.getsockname()[0]
+        except OSError:
+            return '127.0.0.1'
+        finally:
+            sock_fd.close()
+
     @staticmethod
     def TcpSockInit(ip_addr: str, port_num: int) -> socket:
         sock_fd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -196,8 +367,42 @@ class Util(object):
                            socket.IP_ADD_MEMBERSHIP,
                            multicast_group)
 
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def IsLocalIp(ip_addr: str) -> bool:
+        """
+        :param ip_addr: an ipv4 address
+        :return: True if it is an address of this host
+        """
+        sock_fd = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            # binding only succeeds on a local address
+            sock_fd.bind((ip_addr, 0))
+            return True
+        except OSError:
+            return False
+        finally:
+            sock_fd.close()
+
     @staticmethod
     def SendAckToSub(udp_unicast_sock: socket,
                      ip_addr: str,
                      port_num: int) -> None:
         udp_unicast_sock.sendto(b'ACK', (ip_addr, port_num))
+
+    @staticmethod
+    def SetSockBufSize(sock_fd: socket,
+                       rcvbuf: Optional[int] = None,
+                       sndbuf: Optional[int] = None) -> None:
+        """
+        sets the kernel buffers of the socket, None keeps the system default
+
+        :param sock_fd: the socket to adjust
+        :param rcvbuf: size in bytes of the receive buffer
+        :param sndbuf: size in bytes of the send buffer
+        :return: None
+        """
+        if rcvbuf:
+            sock_fd.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        if sndbuf:
+            sock_fd.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
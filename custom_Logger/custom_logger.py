@@ -3,11 +3,19 @@ import datetime
 
 
 class MyLogger:
+    _is_initialized = False
+
     @staticmethod
     def Init(logger_name, log_file_path):
+        # configure once per process, later entities share the handlers
+        if MyLogger._is_initialized:
+            return
+        MyLogger._is_initialized = True
         current_time = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
         log_file_path_with_time = f"{log_file_path}_{current_time}.log"
         logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %('
                                           'levelname)s - %(message)s',
-                            handlers=[logging.FileHandler(log_file_path_with_time),
+                            # the log file is only opened on the first record
+                            handlers=[logging.FileHandler(log_file_path_with_time,
+                                                          delay=True),
                              logging.StreamHandler()])
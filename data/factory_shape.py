@@ -1,6 +1,7 @@
 from typing import List
 from typing import Callable
 from data.shape import Shape, Circle, Square, Triangle
+from data.schema import Field, ShapeSchema, registry
 from enum import IntEnum
 
 
@@ -10,6 +11,20 @@ class ShapeType(IntEnum):
     TRIANGLE = 3
 
 
+# built in shapes, new shapes are added by registering their schema
+registry.Register(ShapeSchema(ShapeType.CIRCLE, "circle",
+                              (Field("radius", int), Field("color", str))),
+                  Circle)
+registry.Register(ShapeSchema(ShapeType.SQUARE, "square",
+                              (Field("height", int), Field("length", int),
+                               Field("color", str))),
+                  Square)
+registry.Register(ShapeSchema(ShapeType.TRIANGLE, "triangle",
+                              (Field("height", int), Field("base", int),
+                               Field("color", str))),
+                  Triangle)
+
+
 class ShapeFactory:
     def __init__(self):
         self._create_funcs = {
@@ -18,14 +33,19 @@ class ShapeFactory:
             ShapeType.TRIANGLE: self._create_triangle
         }
 
-    def register_shape(self, type_: ShapeType, creator: Callable):
+    def register_shape(self, type_: int, creator: Callable):
         self._create_funcs[type_] = creator
 
-    def create_shape(self, type_: ShapeType, params: List) -> Shape:
+    def create_shape(self, type_: int, params: List) -> Shape:
         try:
             create_func = self._create_funcs[type_]
         except KeyError:
-            raise ValueError(f"Invalid shape type: {type_.name}")
+            # shapes registered in the schema registry after the factory
+            # was created
+            create_func = registry.Creators().get(type_)
+            if create_func is None:
+                raise ValueError(f"Invalid shape type: {type_}")
+            self._create_funcs[type_] = create_func
         return create_func(*params)
 
     @staticmethod
@@ -0,0 +1,210 @@
+import struct
+import threading
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+# a schema encoded message starts with this prefix followed by the
+# type id and the schema version of the shape
+SCHEMA_MAGIC = b'\xf0S'
+_HEADER_FORMAT = '!2sHB'
+_HEADER = struct.Struct(_HEADER_FORMAT)
+
+_INT32_MIN = -2 ** 31
+_INT32_MAX = 2 ** 31 - 1
+
+
+@dataclass(frozen=True)
+class Field:
+    name: str
+    type: type  # int, float or str
+    max_len: int = 15  # max encoded length of a str field
+
+
+@dataclass(frozen=True)
+class ShapeSchema:
+    type_id: int
+    name: str
+    fields: Tuple[Field, ...]
+    version: int = 1
+
+
+def _ValidateInt(name: str) -> Callable:
+    def validate(value):
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise ValueError(f"{name} must be int, got {value!r}")
+        if not _INT32_MIN <= value <= _INT32_MAX:
+            raise ValueError(f"{name} out of range: {value}")
+        return value
+    return validate
+
+
+def _ValidateFloat(name: str) -> Callable:
+    def validate(value):
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            raise ValueError(f"{name} must be a number, got {value!r}")
+        return value
+    return validate
+
+
+def _ValidateStr(name: str, max_len: int) -> Callable:
+    def validate(value):
+        if not isinstance(value, str):
+            raise ValueError(f"{name} must be str, got {value!r}")
+        encoded = value.encode('utf-8')
+        if len(encoded) > max_len:
+            raise ValueError(f"{name} is longer than {max_len} bytes")
+        return encoded
+    return validate
+
+
+class ShapeCodec(object):
+    """
+    Encoder and decoder of a single schema version.
+    Everything is compiled once, encoding is a single struct.pack call.
+    """
+
+    def __init__(self, schema: ShapeSchema) -> None:
+        formats = []
+        validators = []
+        str_indices = []
+        for index, field in enumerate(schema.fields):
+            if field.type is int:
+                formats.append('i')
+                validators.append(_ValidateInt(field.name))
+            elif field.type is float:
+                formats.append('d')
+                validators.append(_ValidateFloat(field.name))
+            elif field.type is str:
+                if not 0 < field.max_len < 256:
+                    raise ValueError(f"{field.name}: max_len must be in "
+                                     f"range 1..255")
+                # pascal string, the length byte is part of the field
+                formats.append(f"{field.max_len + 1}p")
+                validators.append(_ValidateStr(field.name, field.max_len))
+                str_indices.append(index)
+            else:
+                raise ValueError(f"{field.name}: unsupported field type "
+                                 f"{field.type}")
+        self.schema = schema
+        self._struct = struct.Struct(_HEADER_FORMAT + ''.join(formats))
+        self._header = (SCHEMA_MAGIC, schema.type_id, schema.version)
+        self._validators = tuple(validators)
+        self._str_indices = tuple(str_indices)
+        self._n_fields = len(validators)
+
+    def Validate(self, params: List) -> List:
+        """
+        :param params: field values in schema order
+        :return: the values as they are packed
+        :exception: ValueError if the params do not match the schema
+        """
+        if len(params) != self._n_fields:
+            raise ValueError(f"{self.schema.name} expects {self._n_fields} "
+                             f"params, got {len(params)}")
+        return [validate(value)
+                for validate, value in zip(self._validators, params)]
+
+    def Encode(self, params: List) -> bytes:
+        return self._struct.pack(*self._header, *self.Validate(params))
+
+    def Decode(self, message: bytes) -> List:
+        # skip the magic, type id and version
+        values = list(self._struct.unpack(message))[3:]
+        for index in self._str_indices:
+            values[index] = values[index].decode('utf-8')
+        return values
+
+
+def MessageVersion(message: bytes) -> Optional[int]:
+    """
+    :param message: an encoded shape message
+    :return: the schema version it is encoded with, None for json
+    """
+    if message[:len(SCHEMA_MAGIC)] != SCHEMA_MAGIC:
+        return None
+    return _HEADER.unpack_from(message)[2]
+
+
+class SchemaRegistry(object):
+    """
+    Registry of the shape schemas known to this process.
+    Codecs are compiled at registration and cached per (type id, version).
+    """
+
+    def __init__(self) -> None:
+        self._codecs: Dict[Tuple[int, int], ShapeCodec] = {}
+        self._latest: Dict[int, int] = {}
+        self._creators: Dict[int, Callable] = {}
+        self._lock = threading.Lock()
+
+    def Register(self, schema: ShapeSchema,
+                 creator: Optional[Callable] = None) -> ShapeCodec:
+        """
+        registers (a version of) a shape schema
+
+        :param schema: the schema to compile
+        :param creator: callable building the shape from its params,
+                        a new version keeps the previous creator when None
+        :return: the compiled codec
+        """
+        codec = ShapeCodec(schema)
+        with self._lock:
+            self._codecs[(schema.type_id, schema.version)] = codec
+            if schema.version >= self._latest.get(schema.type_id, 0):
+                self._latest[schema.type_id] = schema.version
+            if creator is not None:
+                self._creators[schema.type_id] = creator
+        return codec
+
+    def Codec(self, type_id: int,
+              version: Optional[int] = None) -> Optional[ShapeCodec]:
+        """
+        :param type_id: id of the shape
+        :param version: schema version, the latest when None
+        :return: the codec, None if unknown
+        """
+        if version is None:
+            version = self._latest.get(type_id)
+        return self._codecs.get((type_id, version))
+
+    def LatestVersion(self, type_id: int) -> Optional[int]:
+        return self._latest.get(type_id)
+
+    def Negotiate(self, type_id: int, offered: Optional[int]) -> Optional[int]:
+        """
+        picks the newest version known here that is not newer than
+        the one offered by the peer
+
+        :param type_id: id of the shape
+        :param offered: newest version the peer knows, None for json only
+        :return: agreed version, None when json has to be used
+        """
+        if offered is None:
+            return None
+        for version in range(min(offered, self._latest.get(type_id, 0)),
+                             0, -1):
+            if (type_id, version) in self._codecs:
+                return version
+        return None
+
+    def Creators(self) -> Dict[int, Callable]:
+        with self._lock:
+            return dict(self._creators)
+
+    def Decode(self, message: bytes) -> Tuple[int, List]:
+        """
+        decodes a schema encoded message
+
+        :param message: message starting with SCHEMA_MAGIC
+        :return: (type id, params)
+        :exception: ValueError if the schema is not registered
+        """
+        _, type_id, version = _HEADER.unpack_from(message)
+        codec = self._codecs.get((type_id, version))
+        if codec is None:
+            raise ValueError(f"unknown schema {type_id} version {version}")
+        return type_id, codec.Decode(message)
+
+
+# the registry shared by publishers and subscribers of the process
+registry = SchemaRegistry()
@@ -0,0 +1,190 @@
+from common.batch import Batcher, Pack, Unpack
+from common.clock import VirtualClock
+from common.compression import COMPRESSED_MAGIC, Compressor, Decompressor
+from common.fragment import Fragmenter, Reassembler
+from common.util import Priority, Util
+from data.factory_shape import ShapeType
+from data.schema import MessageVersion, registry
+
+# round trips of the wire codecs, and how they fail on malformed input
+
+SRC = ('127.0.0.1', 4545)
+DEST = ('127.0.0.1', 1001)
+
+
+def CheckFragments() -> None:
+    payload = bytes(range(256)) * 10
+    fragments = Fragmenter(100).Fragment(payload)
+    assert len(fragments) > 1
+    assert all(len(fragment) <= 100 for fragment in fragments)
+    reassembler = Reassembler()
+    # delivered out of order, the message completes with the last one
+    results = [reassembler.Feed(fragment, SRC)
+               for fragment in reversed(fragments)]
+    assert results[:-1] == [None] * (len(fragments) - 1)
+    assert results[-1] == payload
+    assert reassembler.PendingBytes() == 0
+    # a payload that fits is sent as is
+    assert Fragmenter(100).Fragment(b'small') == [b'small']
+
+
+def CheckFragmentCountMismatch() -> None:
+    payload = b'x' * 1000
+    # both fragmenters start at sequence 0, the fragments collide
+    first = Fragmenter(100).Fragment(payload)
+    second = Fragmenter(300).Fragment(payload)
+    assert len(first) != len(second)
+    reassembler = Reassembler()
+    assert reassembler.Feed(first[0], SRC) is None
+    assert reassembler.PendingBytes() > 0
+    # the message is dropped, not completed from mixed fragments
+    assert reassembler.Feed(second[1], SRC) is None
+    assert reassembler.PendingBytes() == 0
+
+
+def CheckBatch() -> None:
+    messages = [b'a', b'bc', b'', b'{"type": 1}']
+    assert Unpack(Pack(messages)) == messages
+    # a lone message is not framed
+    assert Pack([b'lone']) == b'lone'
+    assert Unpack(b'lone') == [b'lone']
+
+
+def CheckTruncatedBatch() -> None:
+    datagram = Pack([b'first', b'second'])
+    for size in range(len(Pack([])) + 1, len(datagram)):
+        try:
+            Unpack(datagram[:size])
+        except ValueError:
+            continue
+        raise AssertionError(f"batch cut at {size} bytes was unpacked")
+
+
+def CheckBatcherPriority() -> None:
+    clock = VirtualClock()
+    sent = []
+    batcher = Batcher(lambda datagram, dest: sent.append((dest,
+                                                          Unpack(datagram))),
+                      linger=0.005, clock=clock)
+    batcher.Start()
+    clock.Settle()
+    batcher.Enqueue(b'stale', ('a', 1), Priority.BULK,
+                    expires=clock.Now() + 0.001)
+    batcher.Enqueue(b'bulk', ('a', 1), Priority.BULK)
+    batcher.Enqueue(b'normal', ('b', 1), Priority.NORMAL)
+    batcher.Enqueue(b'pending', ('c', 1), Priority.BULK)
+    # an urgent message takes what is pending for its destination along
+    batcher.Enqueue(b'urgent', ('c', 1), Priority.URGENT)
+    clock.Settle()
+    assert sent == [(('c', 1), [b'pending', b'urgent'])], sent
+    sent.clear()
+    # once lingered, by priority and without the stale message
+    clock.Advance(0.01)
+    assert sent == [(('b', 1), [b'normal']), (('a', 1), [b'bulk'])], sent
+    assert batcher.Stats() == {'dropped': 1}
+    batcher.Stop()
+
+
+def CheckSchema() -> None:
+    for shape_type, params in ((ShapeType.CIRCLE, [5, 'blue']),
+                               (ShapeType.SQUARE, [4, 4, 'green']),
+                               (ShapeType.TRIANGLE, [3, 6, 'yellow'])):
+        version = registry.LatestVersion(shape_type)
+        message = registry.Codec(shape_type, version).Encode(params)
+        assert MessageVersion(message) == version
+        assert registry.Decode(message) == (shape_type, params)
+        # and through the helpers the publisher and subscriber use
+        assert Util.DecodeShape(Util.EncodeShape(shape_type, params,
+                                                 version)) == \
+            (shape_type, params)
+    codec = registry.Codec(ShapeType.CIRCLE,
+                           registry.LatestVersion(ShapeType.CIRCLE))
+    for params in ([5], [5, 'blue', 1], ['5', 'blue'],
+                   [5, 'a color name longer than a field']):
+        try:
+            codec.Encode(params)
+        except ValueError:
+            continue
+        raise AssertionError(f"{params} was encoded")
+    # params that do not fit the schema go out as json instead
+    message = Util.EncodeShape(ShapeType.SQUARE, [2.5, 3, 'red'],
+                               registry.LatestVersion(ShapeType.SQUARE))
+    assert MessageVersion(message) is None
+    assert Util.DecodeShape(message) == (ShapeType.SQUARE, [2.5, 3, 'red'])
+
+
+def CheckCompression() -> None:
+    compressor = Compressor()
+    decompressor = Decompressor()
+    payload = Pack([b'{"type": 1, "params": [5, "blue"]}',
+                    b'{"type": 2, "params": [4, 4, "blue"]}'])
+    # nothing is compressed for a destination that did not ask for it
+    assert compressor.Compress(payload, DEST) is payload
+    compressor.Open(DEST, decompressor.Known())
+    compressor.Intern('blue')
+    for _ in range(3):
+        frame = compressor.Compress(payload, DEST)
+        assert decompressor.Decompress(frame) == payload
+    # the escape byte itself survives, and memoryviews are accepted
+    raw = b'\xf1\xf1\x80 blue' * 20
+    frame = compressor.Compress(memoryview(raw), DEST)
+    assert frame.startswith(COMPRESSED_MAGIC)
+    assert decompressor.Decompress(frame) == raw
+
+
+def CheckMissingString() -> None:
+    compressor = Compressor()
+    compressor.Open(DEST, {})
+    compressor.Intern('purple')
+    payload = b'{"type": 1, "params": [5, "purple"]}' * 4
+    # the frame defining the string is lost
+    defining = compressor.Compress(payload, DEST)
+    frame = compressor.Compress(payload, DEST)
+    try:
+        Decompressor().Decompress(frame)
+    except LookupError:
+        pass
+    else:
+        raise AssertionError("decompressed without the interned string")
+    # corrupt frames are told apart from the missing strings
+    body = defining.index(b'purple') + len(b'purple')
+    for frame in (defining[:3], defining[:body - 2], defining[:-1],
+                  defining[:body] + b'\xff' * 8):
+        try:
+            Decompressor().Decompress(frame)
+        except LookupError:
+            raise AssertionError("corrupt frame reported as a lost one")
+        except ValueError:
+            pass
+
+
+def CheckCompressionBomb() -> None:
+    compressor = Compressor()
+    compressor.Open(DEST, {})
+    compressor.Intern('x' * 200)
+    decompressor = Decompressor(max_size=4000)
+    # inflating, then expanding the interned strings, is bounded
+    for payload in (b'\x00' * 5000, b'x' * 200 * 50):
+        frame = compressor.Compress(payload, DEST)
+        assert frame.startswith(COMPRESSED_MAGIC) and len(frame) < 1000
+        try:
+            decompressor.Decompress(frame)
+        except ValueError:
+            continue
+        raise AssertionError(f"frame expanded to {len(payload)} bytes")
+    # the publisher does not compress what the subscriber would reject
+    payload = b'\x00' * (Util.max_buf_size + 1)
+    assert compressor.Compress(payload, DEST) is payload
+
+
+def main() -> int:
+    for check in (CheckFragments, CheckFragmentCountMismatch, CheckBatch,
+                  CheckTruncatedBatch, CheckBatcherPriority, CheckSchema,
+                  CheckCompression, CheckMissingString, CheckCompressionBomb):
+        check()
+        print(f"{check.__name__} ok")
+    return 0
+
+
+if __name__ == "__main__":
+    main()
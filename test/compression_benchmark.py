@@ -0,0 +1,52 @@
+import sys
+from common.clock import VirtualClock
+from common.transport import LoopbackTransport
+from common.util import PublisherParams, SubscriberParams
+from data.factory_shape import ShapeType
+from PUB.publisher import Publisher
+from SUB.subscriber import Subscriber
+
+# bytes a publisher puts on the wire for a compressing subscriber, with and
+# without batching, measured over the loopback transport on virtual time
+
+
+def Measure(batch_linger: float, virtual_seconds: float) -> dict:
+    clock = VirtualClock()
+    transport = LoopbackTransport(clock=clock)
+    pub_params = [PublisherParams(shape_type=ShapeType.CIRCLE, freq=0.1,
+                                  params=[5, "blue"]),
+                  PublisherParams(shape_type=ShapeType.SQUARE, freq=0.1,
+                                  params=[4, 4, "green"]),
+                  PublisherParams(shape_type=ShapeType.TRIANGLE, freq=0.1,
+                                  params=[3, 6, "yellow"])]
+    publisher = Publisher(4545, pub_params, batch_linger=batch_linger,
+                          transport=transport, clock=clock)
+    publisher.Publish()
+    subscriber = Subscriber(SubscriberParams(
+        shape_types=[ShapeType.CIRCLE, ShapeType.SQUARE,
+                     ShapeType.TRIANGLE],
+        subscriber_udp_recv_port_num=1001,
+        shape_handler=lambda shape: None,
+        discovery=False,
+        compression=True), transport=transport, clock=clock)
+    subscriber.Subscribe(4545)
+    clock.Advance(virtual_seconds)
+    subscriber.Stop()
+    publisher.Stop()
+    return publisher.CompressionStats()
+
+
+def main() -> int:
+    virtual_seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10.0
+    print(f"{'batching':<10}{'bytes in':>10}{'bytes out':>11}{'saved':>8}")
+    for batch_linger in (0, 0.005):
+        stats = Measure(batch_linger, virtual_seconds)
+        saved = 1 - stats['bytes_out'] / max(stats['bytes_in'], 1)
+        print(f"{'on' if batch_linger else 'off':<10}"
+              f"{stats['bytes_in']:>10}{stats['bytes_out']:>11}"
+              f"{saved:>8.0%}")
+    return 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import sys
+import threading
+import time
+from common.clock import VirtualClock
+from common.transport import LoopbackTransport
+from common.util import PublisherParams, SubscriberParams
+from data.factory_shape import ShapeType
+from PUB.publisher import Publisher
+from SUB.subscriber import Subscriber
+
+# runs a publisher and many subscribers in one process over the loopback
+# transport, on virtual time, so what is measured is the library itself:
+# no kernel, no network and no sleeping
+
+
+def main() -> int:
+    num_subscribers = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    virtual_seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+    server_port = 4545
+
+    clock = VirtualClock()
+    transport = LoopbackTransport(clock=clock)
+    received = [0]
+    received_lock = threading.Lock()
+
+    def CountShape(shape) -> None:
+        with received_lock:
+            received[0] += 1
+
+    pub_params = [PublisherParams(shape_type=ShapeType.CIRCLE, freq=0.1,
+                                  params=[5, 'red']),
+                  PublisherParams(shape_type=ShapeType.SQUARE, freq=0.25,
+                                  params=[4, 4, 'blue'])]
+    # without linger nothing waits on real time. all the subscribers share
+    # the loopback host, which may register all its shapes at once
+    publisher = Publisher(server_port, pub_params, batch_linger=0,
+                          transport=transport, clock=clock,
+                          request_burst=2 * num_subscribers)
+    publisher.Publish()
+
+    subscribers = []
+    setup_start = time.perf_counter()
+    for index in range(num_subscribers):
+        sub_params = SubscriberParams(
+            shape_types=[ShapeType.CIRCLE, ShapeType.SQUARE],
+            subscriber_udp_recv_port_num=10000 + index,
+            shape_handler=CountShape,
+            discovery=False)
+        subscriber = Subscriber(sub_params, transport=transport, clock=clock)
+        subscriber.Subscribe(server_port)
+        subscribers.append(subscriber)
+    clock.Settle()
+    setup_time = time.perf_counter() - setup_start
+
+    run_start = time.perf_counter()
+    clock.Advance(virtual_seconds)
+    run_time = time.perf_counter() - run_start
+
+    for subscriber in subscribers:
+        subscriber.Stop()
+    publisher.Stop()
+
+    print(f"{num_subscribers} subscribers, {virtual_seconds} virtual seconds")
+    print(f"setup {setup_time * 1e3:.1f} ms, "
+          f"run {run_time * 1e3:.1f} ms")
+    print(f"{received[0]} shapes delivered, "
+          f"{run_time / max(received[0], 1) * 1e6:.1f} us per shape")
+    return 0
+
+
+if __name__ == "__main__":
+    main()
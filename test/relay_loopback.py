@@ -0,0 +1,105 @@
+import sys
+import threading
+from collections import Counter
+from common.clock import VirtualClock
+from common.transport import LoopbackNetwork, LoopbackTransport
+from common.util import PublisherParams, SubscriberParams
+from data.factory_shape import ShapeType
+from PUB.publisher import Publisher
+from RELAY.relay import Relay
+from SUB.subscriber import Subscriber
+
+# runs an upstream publisher, a relay and its local subscribers in one
+# process, discovery on, and checks the upstream publisher sends a single
+# copy of every update, to the relay, however many local subscribers there are
+
+UPSTREAM_PORT = 4545
+LOCAL_PORT = 4547
+RELAY_RECV_PORT = 9000
+
+
+class _CountingNetwork(LoopbackNetwork):
+    """
+    counts the datagrams sent from every port to every port
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.sent: Counter = Counter()
+        self._count_lock = threading.Lock()
+
+    def Deliver(self, data: bytes, src_addr: tuple, dest: tuple) -> None:
+        with self._count_lock:
+            self.sent[(src_addr[1], dest[1])] += 1
+        super().Deliver(data, src_addr, dest)
+
+
+def main() -> int:
+    num_subscribers = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    virtual_seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+
+    clock = VirtualClock()
+    network = _CountingNetwork()
+    transport = LoopbackTransport(network, clock)
+    received = Counter()
+    received_lock = threading.Lock()
+
+    def CountShape(shape) -> None:
+        with received_lock:
+            received[type(shape).__name__] += 1
+
+    publisher = Publisher(UPSTREAM_PORT,
+                          [PublisherParams(shape_type=ShapeType.CIRCLE,
+                                           freq=0.1, params=[5, 'red']),
+                           PublisherParams(shape_type=ShapeType.SQUARE,
+                                           freq=0.25, params=[4, 4, 'blue'])],
+                          batch_linger=0, transport=transport, clock=clock)
+    publisher.Publish()
+    relay = Relay(UPSTREAM_PORT, LOCAL_PORT, RELAY_RECV_PORT, batch_linger=0,
+                  transport=transport, clock=clock)
+    relay.Start()
+
+    subscribers = []
+    for index in range(num_subscribers):
+        subscriber = Subscriber(
+            SubscriberParams(shape_types=[ShapeType.CIRCLE, ShapeType.SQUARE],
+                             subscriber_udp_recv_port_num=10000 + index,
+                             shape_handler=CountShape),
+            transport=transport, clock=clock)
+        subscriber.Subscribe(LOCAL_PORT)
+        subscribers.append(subscriber)
+    # let the announcements and registrations go around
+    clock.Advance(2 * 1.5)
+    network.sent.clear()
+    received.clear()
+    clock.Advance(virtual_seconds)
+
+    upstream_subs = {shape: list(subs)
+                     for shape, subs in publisher._sub_map.items()}
+    upstream_sent = {dest: count for (src, dest), count
+                     in network.sent.items() if src == UPSTREAM_PORT}
+    interest = relay.Interest()
+    for subscriber in subscribers:
+        subscriber.Stop()
+    relay.Stop()
+    publisher.Stop()
+
+    print(f"{num_subscribers} local subscribers, "
+          f"{virtual_seconds} virtual seconds")
+    print(f"upstream registrations {upstream_subs}")
+    print(f"upstream datagrams per destination port {upstream_sent}")
+    print(f"shapes delivered locally {dict(received)}")
+    assert interest == [ShapeType.CIRCLE, ShapeType.SQUARE]
+    # the relay is the only upstream subscriber, and the only destination
+    assert all(len(subs) == 1 for subs in upstream_subs.values()), \
+        upstream_subs
+    assert list(upstream_sent) == [RELAY_RECV_PORT], upstream_sent
+    # every local subscriber got every update through the relay
+    assert received['Circle'] >= num_subscribers * (virtual_seconds / 0.1 - 1)
+    assert received['Square'] >= num_subscribers * (virtual_seconds / 0.25 - 1)
+    print("ok")
+    return 0
+
+
+if __name__ == "__main__":
+    main()
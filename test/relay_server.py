@@ -0,0 +1,21 @@
+import time
+from RELAY.relay import Relay
+
+
+def main() -> int:
+    upstream_port = 4545  # where publisher_server.py takes registrations
+    local_port = 4547  # subscribers of this site subscribe here
+    try:
+        relay = Relay(upstream_port, local_port, upstream_recv_port=1003)
+        relay.Start()
+        time.sleep(100)  # relaying for 100 seconds
+        relay.Stop()
+
+    except Exception as e:
+        print(e)
+        return -1
+    return 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# runs in a fresh interpreter, as a short lived subscriber process would
+CHILD = """
+import json, sys, time
+t0 = time.perf_counter()
+from SUB.subscriber import Subscriber
+from common.util import SubscriberParams
+from data.factory_shape import ShapeType
+t1 = time.perf_counter()
+sub = Subscriber(SubscriberParams(shape_types=[ShapeType.CIRCLE],
+                                  subscriber_udp_recv_port_num=0,
+                                  discovery=False,
+                                  fast_start=sys.argv[1] == '1'))
+t2 = time.perf_counter()
+sub.Subscribe(4545)  # returns once the first registration is sent
+t3 = time.perf_counter()
+print(json.dumps({'import': t1 - t0, 'init': t2 - t1, 'subscribe': t3 - t2,
+                  'total': t3 - t0}))
+sub.Stop()
+"""
+
+
+def Measure(fast_start: bool, runs: int) -> dict:
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', CHILD,
+                              '1' if fast_start else '0'],
+                             env=env, capture_output=True, text=True,
+                             check=True).stdout
+        samples.append(json.loads(out.strip().splitlines()[-1]))
+    return {key: statistics.median(sample[key] for sample in samples)
+            for key in samples[0]}
+
+
+def main() -> int:
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    print(f"median of {runs} subscriber processes, in ms")
+    print(f"{'mode':<10}{'import':>10}{'init':>10}{'subscribe':>12}"
+          f"{'total':>10}")
+    for fast_start in (False, True):
+        result = Measure(fast_start, runs)
+        print(f"{'fast' if fast_start else 'default':<10}"
+              f"{result['import'] * 1e3:>10.2f}{result['init'] * 1e3:>10.2f}"
+              f"{result['subscribe'] * 1e3:>12.2f}"
+              f"{result['total'] * 1e3:>10.2f}")
+    return 0
+
+
+if __name__ == '__main__':
+    main()